@@ -25,20 +25,36 @@
 # shouldn't be too difficult.
 
 import argparse
+import hashlib
 import json
 import logging
 import os
 import pickle
+import Queue
+import random
 import requests
+import shutil
 import signal
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 import urlparse
 
 # BIG-IQ is limited to importing from this path for security reasons.
 FILE_IMPORT_DIR = '/var/config/rest/downloads'
 
+# Files downloaded by earlier runs, named by BIG-IP checksum. It sits on the
+# same filesystem as FILE_IMPORT_DIR so that files can be hard linked across.
+FILE_CACHE_DIR = os.path.join(
+    os.path.dirname(FILE_IMPORT_DIR), 'ssl-import-cache')
+
+# Progress records for runs that didn't complete, one file per BIG-IP.
+JOURNAL_DIR = os.path.join(
+    os.path.dirname(FILE_IMPORT_DIR), 'ssl-import-journal')
+
 IMPORT_TASK_PATH = 'cm/adc-core/tasks/certificate-management'
 
 FINAL_TASK_STATUSES = [
@@ -47,6 +63,22 @@ FINAL_TASK_STATUSES = [
     'FINISHED',
 ]
 
+# The only BIG-IQ file object fields we look at.
+BIGIQ_FILE_OBJECT_FIELDS = [
+    'name',
+    'partition',
+    'subPath',
+    'checksum',
+    'kind',
+    'selfLink',
+    'fileReference',
+]
+
+# Objects with a file already attached are managed and of no interest.
+BIGIQ_UNMANAGED_FILTER = "not ('fileReference/link' eq '*')"
+
+BIGIQ_PAGE_SIZE = 500
+
 def get_rest_path(uri):
     '''
     Given a URI string, extract the path portion and remove any leading /mgmt.
@@ -147,12 +179,14 @@ class FileObject(object):
     Object representing information about a specific file object.
     '''
 
-    def __init__(self, fullpath, rest_path, cache_path, password, obj_type):
+    def __init__(self, fullpath, rest_path, cache_path, password, obj_type,
+                 checksum=None):
         self._fullpath = fullpath
         self._rest_path = rest_path
         self._cache_path = cache_path
         self._password = password
         self._obj_type = obj_type
+        self._checksum = checksum
 
     def __repr__(self):
         return ('<FileObject %r, %r, %r>' %
@@ -178,6 +212,10 @@ class FileObject(object):
     def obj_type(self):
         return self._obj_type
 
+    @property
+    def checksum(self):
+        return self._checksum
+
     @classmethod
     def from_object_states(cls, bigip_state, bigiq_state):
         bigip_fullpath = bigip_state['name']
@@ -209,9 +247,55 @@ class FileObject(object):
             get_rest_path(bigiq_state['selfLink']),
             bigip_state['cache_path'],
             bigip_state.get('passphrase'),
-            found_type)
+            found_type,
+            bigip_checksum)
+
+def parse_checksum(checksum):
+    '''
+    BIG-IP file object checksums look like SHA1:<size>:<hex digest>. Returns
+    a triple (hashlib algorithm name, size, hex digest), or None if the
+    checksum isn't in a form we understand.
+    '''
+    bits = (checksum or '').split(':')
+    if len(bits) != 3:
+        return None
+
+    algorithm, size, digest = bits
+    try:
+        hashlib.new(algorithm.lower())
+        size = int(size)
+    except ValueError:
+        return None
+
+    return (algorithm.lower(), size, digest.lower())
+
+def file_matches_checksum(path, checksum):
+    '''
+    Check a local file against a BIG-IP checksum. Returns None if the
+    checksum can't be interpreted, otherwise True or False.
+    '''
+    parsed = parse_checksum(checksum)
+    if parsed is None:
+        return None
+
+    algorithm, size, digest = parsed
+
+    h = hashlib.new(algorithm)
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    h.update(data)
+
+    return len(data) == size and h.hexdigest() == digest
 
-def make_bigip_query_cmd(object_type):
+def make_bigip_query_cmd(object_type_names):
+    '''
+    Build a command which queries all the given MCP types using a single
+    interpreter and MCP connection on the BIG-IP. It prints a pickled dict
+    mapping each type name to the list of objects found.
+    '''
     # This will be joined into one line, but it's easier to read this way.
     script = [
         'import f5.mcp, pickle;',
@@ -220,8 +304,9 @@ def make_bigip_query_cmd(object_type):
         'attrs=["cache_path","name","checksum","passphrase"];',
         # Function to translate objects into a pickleable form.
         'm=lambda d: dict((k,v) for (k,v) in d.items() if k in attrs);',
-        'r=f5.mcp.MCPConnection().query_all("' + object_type + '");',
-        'print pickle.dumps([m(o) for o in r])'
+        'c=f5.mcp.MCPConnection();',
+        't=' + json.dumps(list(object_type_names)) + ';',
+        'print pickle.dumps(dict((n,[m(o) for o in c.query_all(n)]) for n in t))'
     ]
 
     return [
@@ -230,6 +315,55 @@ def make_bigip_query_cmd(object_type):
         ''.join(script)
     ]
 
+# Runs on the BIG-IP for the life of an SshConnection, answering requests on
+# stdin so that each query doesn't need a new ssh session, interpreter and MCP
+# connection. Requests and responses are pickles, each preceded by a line
+# giving its length. A request is (operation, args), and the response is
+# ("ok", result) or ("error", message).
+AGENT_SCRIPT = '''
+import hashlib, pickle, sys
+
+attrs = ["cache_path", "name", "checksum", "passphrase"]
+mcp = []
+
+def query(type_names):
+    if not mcp:
+        import f5.mcp
+        mcp.append(f5.mcp.MCPConnection())
+    result = {}
+    for n in type_names:
+        result[n] = [dict((k, v) for (k, v) in o.items() if k in attrs)
+                     for o in mcp[0].query_all(n)]
+    return result
+
+def checksum(paths):
+    result = {}
+    for p in paths:
+        try:
+            data = open(p, "rb").read()
+        except IOError:
+            result[p] = None
+            continue
+        result[p] = "SHA1:%d:%s" % (len(data), hashlib.sha1(data).hexdigest())
+    return result
+
+ops = {"query": query, "checksum": checksum}
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    op, args = pickle.loads(sys.stdin.read(int(line)))
+    try:
+        response = ("ok", ops[op](*args))
+    except Exception, e:
+        response = ("error", "%s: %s" % (e.__class__.__name__, e))
+    data = pickle.dumps(response)
+    sys.stdout.write("%d\\n" % len(data))
+    sys.stdout.write(data)
+    sys.stdout.flush()
+'''
+
 def make_associate_task_state(rest_path, file_path, password, obj_type):
     body = {
         'command': obj_type.task_associate_cmd,
@@ -253,22 +387,199 @@ def check_http_response(resp):
 
     return resp
 
-def run_task(session, uri, body):
+def submit_task(session, uri, body):
     # This particular request requires authentication, but it doesn't check the
     # authentication and basic auth apparently works even if not enabled.
     resp = check_http_response(
         session.post(uri, data=json.dumps(body), auth=('admin','')))
 
-    task = resp.json()
+    return resp.json()
+
+class TaskPollPolicy(object):
+    '''
+    How to wait for a running task. The interval between polls starts short
+    and grows exponentially, with some random jitter so that many tasks
+    started together don't all poll in lock-step. A task still running after
+    deadline seconds is given up on. A deadline of None waits forever.
+    '''
+
+    # Only the fields needed to decide whether a task is done.
+    POLL_PARAMS = {'$select': 'status,selfLink'}
+
+    def __init__(self, initial_interval=.25, max_interval=5.0, multiplier=1.5,
+                 jitter=.25, deadline=600.0):
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._deadline = deadline
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    def first_interval(self):
+        return self._initial_interval
+
+    def next_interval(self, interval):
+        return min(interval * self._multiplier, self._max_interval)
+
+    def jittered(self, interval):
+        return interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+class TaskPoll(object):
+    '''
+    Polling state and statistics for one outstanding task.
+    '''
+
+    def __init__(self, key, task_uri, policy):
+        self._key = key
+        self._task_uri = task_uri
+        self._policy = policy
+        self._start = time.time()
+        self._polls = 0
+        self._interval = policy.first_interval()
+        self._next_poll_at = self._start + policy.jittered(self._interval)
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def task_uri(self):
+        return self._task_uri
+
+    @property
+    def polls(self):
+        return self._polls
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start
+
+    @property
+    def next_poll_at(self):
+        return self._next_poll_at
+
+    def is_due(self, now):
+        return now >= self._next_poll_at
+
+    def is_expired(self):
+        deadline = self._policy.deadline
+        return deadline is not None and self.elapsed >= deadline
 
-    task_uri = make_local_uri(get_rest_path(task['selfLink']))
+    def poll(self, session):
+        self._polls += 1
+        task = check_http_response(
+            session.get(self._task_uri, params=TaskPollPolicy.POLL_PARAMS)).json()
 
-    while task['status'] not in FINAL_TASK_STATUSES:
-        time.sleep(.5)
-        resp = check_http_response(session.get(task_uri))
-        task = resp.json()
+        self._interval = self._policy.next_interval(self._interval)
+        self._next_poll_at = time.time() + self._policy.jittered(self._interval)
 
-    return task
+        return task
+
+class TaskStats(object):
+    '''
+    How long a task ran, how many polls it took, and whether we gave up on it.
+    '''
+
+    def __init__(self, polls, elapsed, timed_out=False):
+        self.polls = polls
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+def run_tasks(session, uri, keyed_bodies, max_in_flight=1, policy=None,
+              resumed=None, on_submit=None):
+    '''
+    Submit a task for each (key, body) pair in keyed_bodies, keeping at most
+    max_in_flight tasks outstanding at once. Each outstanding task is polled
+    according to the given TaskPollPolicy. Generates (key, final_task,
+    TaskStats) triples in the order the tasks finish.
+
+    A task which passes the policy's deadline is yielded with its last seen
+    (non-final) state and stats.timed_out set.
+
+    keyed_bodies may also produce None, meaning nothing is ready to submit
+    yet; outstanding tasks continue to be polled in the meantime.
+
+    Tasks submitted by an earlier run can be waited for by passing them as
+    (key, task_uri) pairs in resumed. on_submit, if given, is called with
+    (key, task) for each newly submitted task.
+    '''
+    if policy is None:
+        policy = TaskPollPolicy()
+
+    bodies = iter(keyed_bodies)
+    exhausted = False
+    in_flight = []
+
+    for key, task_uri in resumed or []:
+        in_flight.append(TaskPoll(key, task_uri, policy))
+
+    while True:
+        while not exhausted and len(in_flight) < max_in_flight:
+            try:
+                keyed_body = bodies.next()
+            except StopIteration:
+                exhausted = True
+                break
+
+            if keyed_body is None:
+                break
+
+            key, body = keyed_body
+            task = submit_task(session, uri, body)
+            if on_submit is not None:
+                on_submit(key, task)
+
+            if task['status'] in FINAL_TASK_STATUSES:
+                yield key, task, TaskStats(0, 0.0)
+            else:
+                task_uri = make_local_uri(get_rest_path(task['selfLink']))
+                in_flight.append(TaskPoll(key, task_uri, policy))
+
+        if not in_flight:
+            if exhausted:
+                return
+            continue
+
+        wait = min([p.next_poll_at for p in in_flight]) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        now = time.time()
+        still_running = []
+        for p in in_flight:
+            if not p.is_due(now):
+                still_running.append(p)
+                continue
+
+            task = p.poll(session)
+
+            if task['status'] in FINAL_TASK_STATUSES:
+                if task['status'] != 'FINISHED':
+                    # The selected fields don't say why, fetch the whole task.
+                    task = check_http_response(session.get(p.task_uri)).json()
+                stats = TaskStats(p.polls, p.elapsed)
+                logging.debug(
+                    "Task %s %s after %d polls, %.1fs",
+                    p.task_uri,
+                    task['status'],
+                    stats.polls,
+                    stats.elapsed)
+                yield p.key, task, stats
+            elif p.is_expired():
+                stats = TaskStats(p.polls, p.elapsed, timed_out=True)
+                logging.warning(
+                    "Task %s still %s after %.1fs, giving up on it",
+                    p.task_uri,
+                    task['status'],
+                    stats.elapsed)
+                yield p.key, task, stats
+            else:
+                still_running.append(p)
+
+        in_flight = still_running
 
 def escape_for_openssh(cmd):
     # OpenSSH joins the words of the command together with a space between, then
@@ -290,6 +601,62 @@ def escape_for_openssh(cmd):
 
     return ' '.join(escaped_words)
 
+class RemoteAgent(object):
+    '''
+    Client for AGENT_SCRIPT running on the far end of an SshConnection.
+    '''
+
+    def __init__(self, ssh_cmd):
+        self._lock = threading.Lock()
+        self._stderr_file = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            ssh_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr_file)
+
+    def call(self, op, *args):
+        '''
+        Run the given operation on the BIG-IP and return its result. Raises
+        StandardError if the operation fails or the agent has gone away.
+        '''
+        request = pickle.dumps((op, args))
+
+        self._lock.acquire()
+        try:
+            try:
+                self._proc.stdin.write('%d\n' % len(request))
+                self._proc.stdin.write(request)
+                self._proc.stdin.flush()
+
+                line = self._proc.stdout.readline()
+                if not line:
+                    raise StandardError("BIG-IP agent exited: %s" %
+                                        self._read_stderr())
+                status, result = pickle.loads(
+                    self._proc.stdout.read(int(line)))
+            except IOError, e:
+                raise StandardError("Lost BIG-IP agent: %s" % e)
+        finally:
+            self._lock.release()
+
+        if status != 'ok':
+            raise StandardError("BIG-IP agent %s failed: %s" % (op, result))
+
+        return result
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            pass
+        self._proc.wait()
+        self._stderr_file.close()
+
+    def _read_stderr(self):
+        self._stderr_file.seek(0)
+        return self._stderr_file.read()
+
 class SshConnection(object):
 
     CONTROL_PATH_ARGS = ['-o', 'ControlPath=/tmp/ssl-file-import-%l%h%p%r']
@@ -300,10 +667,13 @@ class SshConnection(object):
         '-o', 'ChallengeResponseAuthentication=no',
     ]
 
-    def __init__(self, addr, port=None):
+    def __init__(self, addr, port=None, batch_mode=False):
         self._addr = addr
         self._port = port
+        self._batch_mode = batch_mode
         self._master_proc = None
+        self._agent = None
+        self._agent_lock = threading.Lock()
 
         self._start_master_proc()
 
@@ -320,21 +690,8 @@ class SshConnection(object):
         stderr_str).
         '''
 
-        ssh_cmd = [
-            'ssh',
-        ]
-
-        ssh_cmd += self.NO_PASSWORD_ARGS
-        ssh_cmd += self.CONTROL_PATH_ARGS
-        ssh_cmd += self._port_args('-p')
-
-        ssh_cmd += [
-            self._user_host(),
-            escape_for_openssh(cmd)
-        ]
-
         proc = subprocess.Popen(
-            ssh_cmd,
+            self._ssh_cmd(cmd),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
@@ -343,28 +700,120 @@ class SshConnection(object):
 
         return (proc.returncode, stdoutdata, stderrdata)
 
-    def get_file(self, remote_src_path, local_dest_path):
+    def get_files(self, remote_src_paths, local_dest_dir):
         '''
-        Copies the given remote file to the given local file.
+        Copies all the given remote files into the given local directory over a
+        single ssh channel, by having the remote end stream them back as a tar
+        archive. Files are stored flat, under their base names. Returns a dict
+        mapping each remote path that was copied to its local path; remote
+        files that couldn't be read are missing from the result.
         '''
 
-        scp_cmd = [
-            'scp',
-            '-q',
-        ]
+        # tar sends a repeated path as a hard link to its first copy.
+        paths = []
+        for path in remote_src_paths:
+            if path not in paths:
+                paths.append(path)
+        wanted = set(paths)
+        result = {}
 
-        scp_cmd += self.NO_PASSWORD_ARGS
-        scp_cmd += self.CONTROL_PATH_ARGS
-        scp_cmd += self._port_args('-P')
+        stderr_file = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+            # Read the list of files from stdin, there may be thousands.
+            self._ssh_cmd(['tar', '-c', '-f', '-', '-T', '-']),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file)
+
+        # tar starts writing the archive before it has read the whole list, so
+        # feed the list from another thread to avoid a pipe deadlock.
+        def write_paths():
+            try:
+                for path in paths:
+                    proc.stdin.write(path + '\n')
+            finally:
+                proc.stdin.close()
+
+        writer = threading.Thread(target=write_paths)
+        writer.setDaemon(True)
+        writer.start()
+
+        try:
+            archive = tarfile.open(fileobj=proc.stdout, mode='r|')
+            for member in archive:
+                # tar strips the leading / from member names.
+                remote_path = '/' + member.name.lstrip('/')
+                if remote_path not in wanted:
+                    continue
+
+                local_path = os.path.join(
+                    local_dest_dir, os.path.basename(remote_path))
+
+                if member.islnk():
+                    # Remote files hard linked to one another arrive once,
+                    # the rest as links to the first which was extracted
+                    # already.
+                    target = result.get('/' + member.linkname.lstrip('/'))
+                    if target is None:
+                        continue
+                    if target != local_path:
+                        if os.path.lexists(local_path):
+                            os.remove(local_path)
+                        shutil.copyfile(target, local_path)
+                    result[remote_path] = local_path
+                    continue
+
+                if not member.isfile():
+                    continue
+
+                src = archive.extractfile(member)
+                # local_path may be a hard link into the file cache from an
+                # earlier download; writing through it would change the
+                # cached copy too, so replace it with a new file.
+                if os.path.lexists(local_path):
+                    os.remove(local_path)
+                dest = open(local_path, 'wb')
+                try:
+                    dest.write(src.read())
+                finally:
+                    dest.close()
+
+                result[remote_path] = local_path
+            archive.close()
+        finally:
+            proc.stdout.close()
+            rc = proc.wait()
+            writer.join()
+
+        if rc != 0:
+            stderr_file.seek(0)
+            logging.warning(
+                "Non-zero exit from BIG-IP file transfer. RC=%d", rc)
+            logging.warning("Command stderr:\n%s", stderr_file.read())
+        stderr_file.close()
 
-        scp_cmd += [
-            self._user_host() + ":" + remote_src_path,
-            local_dest_path,
-        ]
+        return result
 
-        subprocess.check_call(scp_cmd)
+    def get_agent(self):
+        '''
+        Return the RemoteAgent for this connection, starting it on first use.
+        '''
+        self._agent_lock.acquire()
+        try:
+            if self._agent is None:
+                self._agent = RemoteAgent(
+                    self._ssh_cmd(['python', '-c', AGENT_SCRIPT]))
+            return self._agent
+        finally:
+            self._agent_lock.release()
 
     def close(self):
+        agent = self._agent
+        self._agent = None
+
+        if agent is not None:
+            agent.close()
+
         proc = self._master_proc
         self._master_proc = None
 
@@ -375,6 +824,22 @@ class SshConnection(object):
     def _user_host(self):
         return 'root@' + self._addr
 
+    def _ssh_cmd(self, cmd):
+        ssh_cmd = [
+            'ssh',
+        ]
+
+        ssh_cmd += self.NO_PASSWORD_ARGS
+        ssh_cmd += self.CONTROL_PATH_ARGS
+        ssh_cmd += self._port_args('-p')
+
+        ssh_cmd += [
+            self._user_host(),
+            escape_for_openssh(cmd)
+        ]
+
+        return ssh_cmd
+
     def _port_args(self, opt_str):
         if self._port is None:
             return []
@@ -390,6 +855,11 @@ class SshConnection(object):
             '-o', 'ControlMaster=yes',
         ]
 
+        if self._batch_mode:
+            # Several masters may be starting at once, so there is no sensible
+            # way to prompt for a password. Fail instead of hanging.
+            ssh_cmd += ['-o', 'BatchMode=yes']
+
         ssh_cmd += self.CONTROL_PATH_ARGS
         ssh_cmd += self._port_args('-p')
 
@@ -423,9 +893,19 @@ class SshConnection(object):
             raise StandardError(
                 "ssh connection failed, exit code: %d" % master_rc)
 
-def get_bigip_file_objects(connection, object_type_name):
+def get_all_bigip_file_objects(connection, object_type_names):
+    '''
+    Fetch the objects of all the given MCP types in one round trip. Returns a
+    dict keyed by MCP type name.
+    '''
+    try:
+        return connection.get_agent().call('query', list(object_type_names))
+    except StandardError, e:
+        logging.warning(
+            "BIG-IP agent query failed, running a one-off query instead: %s", e)
+
     rc, stdout, stderr = connection.run_cmd(
-        make_bigip_query_cmd(object_type_name))
+        make_bigip_query_cmd(object_type_names))
 
     if (rc != 0):
         logging.error(
@@ -436,10 +916,102 @@ def get_bigip_file_objects(connection, object_type_name):
 
     return pickle.loads(stdout)
 
+def get_bigip_file_objects(connection, object_type_name):
+    return get_all_bigip_file_objects(
+        connection, [object_type_name])[object_type_name]
+
+def iter_bigiq_file_objects(session, uri, page_size=BIGIQ_PAGE_SIZE):
+    '''
+    Generate the unmanaged file objects in a BIG-IQ collection a page at a
+    time, with only BIGIQ_FILE_OBJECT_FIELDS filled in. If BIG-IQ rejects the
+    unmanaged filter, all objects are returned and the caller has to filter
+    them.
+    '''
+    params = {
+        '$filter': BIGIQ_UNMANAGED_FILTER,
+        '$select': ','.join(BIGIQ_FILE_OBJECT_FIELDS),
+        '$top': page_size,
+        # $skip only pages reliably over a stable order.
+        '$orderby': 'selfLink',
+    }
+    skip = 0
+
+    while True:
+        params['$skip'] = skip
+        r = session.get(uri, params=params)
+
+        if r.status_code == 400 and '$filter' in params:
+            logging.debug(
+                "BIG-IQ rejected filter for %s, filtering locally instead", uri)
+            del params['$filter']
+            continue
+
+        body = check_http_response(r).json()
+        items = body.get('items', [])
+        for item in items:
+            yield item
+
+        skip += len(items)
+        total = body.get('totalItems')
+        if (len(items) < page_size or
+                # BIG-IQ ignored $top and sent everything.
+                len(items) > page_size or
+                (total is not None and skip >= total)):
+            return
+
 def get_bigiq_file_objects(session, uri):
-    r = check_http_response(session.get(uri))
+    return list(iter_bigiq_file_objects(session, uri))
+
+class BigiqInventory(object):
+    '''
+    The BIG-IQ file objects of every supported type, fetched once and shared
+    between all the BIG-IPs being imported from.
+
+    Since several BIG-IPs may hold the same file object, the inventory also
+    records which BIG-IQ objects have been claimed for import so that each is
+    only associated once.
+    '''
+
+    def __init__(self, session):
+        self._objects = {}
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+        for obj_type in FileObjectTypes.all_types:
+            # Only keep what could be imported; on a large BIG-IQ that is far
+            # less than the whole collection.
+            self._objects[obj_type.mcp_type_name] = [
+                o for o in iter_bigiq_file_objects(
+                    session, obj_type.get_local_uri())
+                if not is_managed(o) and not is_builtin(o)]
 
-    return r.json()['items']
+    def get_objects(self, obj_type):
+        return self._objects[obj_type.mcp_type_name]
+
+    def claim(self, rest_path):
+        '''
+        Returns True if the caller is the first to claim the given BIG-IQ
+        object, False if it was already claimed.
+        '''
+        self._lock.acquire()
+        try:
+            if rest_path in self._claimed:
+                return False
+            self._claimed.add(rest_path)
+            return True
+        finally:
+            self._lock.release()
+
+    def release(self, rest_path):
+        '''
+        Give up a claim, so that another BIG-IP holding the same object can
+        import it instead.
+        '''
+        self._lock.acquire()
+        try:
+            self._claimed.discard(rest_path)
+        finally:
+            self._lock.release()
 
 def is_managed(o):
     return o.get('fileReference', {}).get('link') is not None
@@ -473,17 +1045,22 @@ def hide_passwords(objs):
 
     return result
 
-def find_unmanaged_objects(session, bigip_connection, object_type):
+def find_unmanaged_objects(session, bigip_connection, object_type,
+                           inventory=None, ip_objects=None):
     type_name = object_type.display_name
 
     # Fetch the objects from each device.
-    ip_objects = get_bigip_file_objects(bigip_connection,
-                                        object_type.mcp_type_name)
+    if ip_objects is None:
+        ip_objects = get_bigip_file_objects(bigip_connection,
+                                            object_type.mcp_type_name)
     logging.debug(
         "Found BIG-IP %s objects:\n%s",
         type_name,
         hide_passwords(ip_objects))
-    iq_objects = get_bigiq_file_objects(session, object_type.get_local_uri())
+    if inventory is None:
+        iq_objects = get_bigiq_file_objects(session, object_type.get_local_uri())
+    else:
+        iq_objects = inventory.get_objects(object_type)
     logging.debug("Found BIG-IQ %s objects:\n%s", type_name, iq_objects)
 
 
@@ -529,39 +1106,279 @@ def find_unmanaged_objects(session, bigip_connection, object_type):
 
     return result
 
-def find_all_unmanaged_objects(session, bigip_connection):
+def find_all_unmanaged_objects(session, bigip_connection, inventory=None):
+    # One remote query for every type, rather than one per type.
+    all_ip_objects = get_all_bigip_file_objects(
+        bigip_connection,
+        [typ.mcp_type_name for typ in FileObjectTypes.all_types])
+
     unmanaged_files = []
     for typ in FileObjectTypes.all_types:
-        unmanaged_files += find_unmanaged_objects(session, bigip_connection, typ)
+        unmanaged_files += find_unmanaged_objects(
+            session,
+            bigip_connection,
+            typ,
+            inventory,
+            all_ip_objects[typ.mcp_type_name])
 
     return unmanaged_files
 
-def fetch_files(bigip_connection, file_objects):
-    for f in file_objects:
-        logging.info("Downloading file %s", f.cache_path)
-        bigip_connection.get_file(f.cache_path, FILE_IMPORT_DIR)
+def get_import_path(file_object):
+    return os.path.join(
+        FILE_IMPORT_DIR,
+        os.path.basename(file_object.cache_path))
 
-def associate_files(session, file_objects):
-    success_count = 0
+def link_or_copy(src_path, dest_path):
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+
+class FileCache(object):
+    '''
+    Content-addressed store of downloaded files, keyed by BIG-IP checksum, so
+    that a byte-identical file is only transferred once no matter how many
+    runs or BIG-IPs it turns up in. Least recently used files are evicted
+    once the cache grows past max_bytes.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        if not os.path.isdir(cache_dir):
+            # The cache holds private keys, keep it to ourselves.
+            os.makedirs(cache_dir, 0700)
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def _path(self, checksum):
+        parsed = parse_checksum(checksum)
+        if parsed is None:
+            return None
+
+        return os.path.join(self._cache_dir, '%s-%d-%s' % parsed)
+
+    def link_into(self, checksum, dest_path):
+        '''
+        If a file with the given checksum is cached, put it at dest_path and
+        return True. Otherwise return False.
+        '''
+        path = self._path(checksum)
+
+        self._lock.acquire()
+        try:
+            if path is None or not os.path.exists(path):
+                self._misses += 1
+                return False
+
+            if not file_matches_checksum(path, checksum):
+                logging.warning("Discarding corrupt cached file %s", path)
+                os.remove(path)
+                self._misses += 1
+                return False
+
+            # Touch it so that eviction sees it as recently used.
+            os.utime(path, None)
+            link_or_copy(path, dest_path)
+            self._hits += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def add(self, checksum, src_path):
+        '''
+        Cache the file at src_path, which must match the given checksum.
+        '''
+        path = self._path(checksum)
+        if path is None:
+            return
+
+        self._lock.acquire()
+        try:
+            if not os.path.exists(path):
+                link_or_copy(src_path, path)
+        finally:
+            self._lock.release()
+
+    def trim(self):
+        '''
+        Evict least recently used files until the cache fits in max_bytes.
+        '''
+        self._lock.acquire()
+        try:
+            entries = []
+            total = 0
+            for name in os.listdir(self._cache_dir):
+                st = os.stat(os.path.join(self._cache_dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+
+            entries.sort()
+            for mtime, size, name in entries:
+                if total <= self._max_bytes:
+                    break
+                logging.debug("Evicting cached file %s", name)
+                os.remove(os.path.join(self._cache_dir, name))
+                total -= size
+        finally:
+            self._lock.release()
+
+def log_remote_checksum(bigip_connection, file_object):
+    '''
+    After a checksum mismatch, say whether the file on the BIG-IP itself has
+    changed since discovery or whether the transfer was bad.
+    '''
+    path = file_object.cache_path
+    try:
+        remote = bigip_connection.get_agent().call('checksum', [path])[path]
+    except StandardError, e:
+        logging.debug("Couldn't checksum %s on the BIG-IP: %s", path, e)
+        return
+
+    if parse_checksum(remote) != parse_checksum(file_object.checksum):
+        logging.warning(
+            "File %s has changed on the BIG-IP since discovery, now %s",
+            path,
+            remote)
+    else:
+        logging.warning("File %s was corrupted in transfer", path)
+
+def fetch_files(bigip_connection, file_objects, cache=None, journal=None):
+    '''
+    Download the given files from the BIG-IP in one bulk transfer and check
+    each against its BIG-IP checksum. Files found in the cache, if given, are
+    linked into place instead of downloaded, as are files the journal says an
+    earlier run already fetched. Returns the list of file objects that are
+    now in place intact.
+    '''
+    fetched = []
+    to_download = []
     for f in file_objects:
-        file_path = os.path.join(
-            FILE_IMPORT_DIR,
-            os.path.basename(f.cache_path))
+        if (journal is not None and
+                journal.get_state(f) == ImportJournal.FETCHED and
+                os.path.exists(get_import_path(f)) and
+                file_matches_checksum(get_import_path(f), f.checksum) is not False):
+            logging.info("Already downloaded file %s", f.cache_path)
+            fetched.append(f)
+        elif cache is not None and cache.link_into(f.checksum, get_import_path(f)):
+            logging.info("Using cached copy of file %s", f.cache_path)
+            fetched.append(f)
+        else:
+            logging.info("Downloading file %s", f.cache_path)
+            to_download.append(f)
+
+    if not to_download:
+        return fetched
+
+    local_paths = bigip_connection.get_files(
+        [f.cache_path for f in to_download],
+        FILE_IMPORT_DIR)
+
+    for f in to_download:
+        local_path = local_paths.get(f.cache_path)
+        if local_path is None:
+            logging.warning("Failed to download file %s", f.cache_path)
+            continue
+
+        matches = file_matches_checksum(local_path, f.checksum)
+        if matches is None:
+            logging.debug(
+                "Can't verify %s, unrecognized checksum %r",
+                f.cache_path,
+                f.checksum)
+        elif not matches:
+            logging.warning(
+                "Downloaded file %s doesn't match BIG-IP checksum %s",
+                f.cache_path,
+                f.checksum)
+            log_remote_checksum(bigip_connection, f)
+            os.remove(local_path)
+            continue
+        elif cache is not None:
+            cache.add(f.checksum, local_path)
 
-        logging.info("Associating %s %s", f.obj_type.display_name, file_path)
+        if journal is not None:
+            journal.record(f, ImportJournal.FETCHED)
 
-        task_body = make_associate_task_state(
-            f.rest_path,
-            file_path,
-            f.password,
-            f.obj_type)
+        fetched.append(f)
+
+    if cache is not None:
+        cache.trim()
+
+    return fetched
+
+def associate_files(session, file_objects, max_in_flight=1, poll_policy=None,
+                    journal=None, on_done=None):
+    '''
+    Associate each downloaded file with its BIG-IQ object. file_objects may be
+    any iterable, including one which produces None while waiting for more
+    files to arrive (see iter_queue). Progress is recorded in the journal, if
+    given, and on_done, if given, is called with each file object, whether
+    its task finished and whether it timed out. Returns the number of
+    successes.
+    '''
+    counts = {'total': 0}
 
-        final_task = run_task(
+    def record_submit(f, task):
+        if journal is not None:
+            journal.record(f, ImportJournal.SUBMITTED, task['selfLink'])
+
+    def make_task_bodies():
+        for f in file_objects:
+            if f is None:
+                yield None
+                continue
+
+            counts['total'] += 1
+            file_path = get_import_path(f)
+
+            logging.info("Associating %s %s", f.obj_type.display_name, file_path)
+
+            task_body = make_associate_task_state(
+                f.rest_path,
+                file_path,
+                f.password,
+                f.obj_type)
+
+            yield f, task_body
+
+    success_count = 0
+    total_polls = 0
+    for f, final_task, stats in run_tasks(
             session,
             make_local_uri(IMPORT_TASK_PATH),
-            task_body)
+            make_task_bodies(),
+            max_in_flight,
+            poll_policy,
+            on_submit=record_submit):
+
+        file_path = get_import_path(f)
+        total_polls += stats.polls
 
         final_status = final_task['status']
+        if on_done is not None:
+            on_done(f, final_status == 'FINISHED', stats.timed_out)
+        if journal is not None and not stats.timed_out:
+            # A timed out task is left as submitted for the next run to
+            # pick up again.
+            if final_status == 'FINISHED':
+                journal.record(f, ImportJournal.FINISHED)
+            else:
+                journal.record(f, ImportJournal.FAILED)
+
         if final_status == 'FINISHED':
             logging.info(
                 "Associate succeeded for %s %s",
@@ -578,7 +1395,495 @@ def associate_files(session, file_objects):
     logging.info(
         "Successfully associated %d of %d files",
         success_count,
-        len(file_objects))
+        counts['total'])
+    logging.debug("Associate tasks took %d polls in total", total_polls)
+
+    return success_count
+
+class ImportJournal(object):
+    '''
+    On-disk record of progress importing from one BIG-IP, so that a run which
+    dies part way can be resumed. Entries are keyed by the BIG-IQ rest_path
+    and the BIG-IP checksum, so a file that has changed since is treated as
+    new work.
+
+    The journal is a file of JSON lines, one per state change, appended as
+    work progresses. It is replayed and compacted when opened, and removed
+    once a run completes with nothing left to do.
+    '''
+
+    FETCHED = 'fetched'
+    SUBMITTED = 'submitted'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, journal_dir, address):
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir, 0700)
+
+        self._path = os.path.join(
+            journal_dir, address.replace('/', '_') + '.journal')
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        if os.path.exists(self._path):
+            self._replay()
+
+        self._compact()
+        self._file = open(self._path, 'a')
+
+    def get_state(self, file_object):
+        entry = self._entries.get(self._key(file_object))
+        if entry is None:
+            return None
+        return entry['state']
+
+    def get_submitted(self):
+        '''
+        Returns (key, task selfLink) for each task submitted but not known to
+        have finished.
+        '''
+        result = []
+        for key, entry in self._entries.items():
+            if entry['state'] == self.SUBMITTED:
+                result.append((key, entry['task']))
+        return result
+
+    def record(self, file_object, state, task_link=None):
+        self.record_key(self._key(file_object), state, task_link)
+
+    def record_key(self, key, state, task_link=None):
+        entry = {'state': state, 'task': task_link}
+
+        self._lock.acquire()
+        try:
+            self._entries[key] = entry
+            self._file.write(self._format(key, entry))
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self._path)
+
+    def _key(self, file_object):
+        return (file_object.rest_path, file_object.checksum)
+
+    def _format(self, key, entry):
+        return json.dumps({
+            'rest_path': key[0],
+            'checksum': key[1],
+            'state': entry['state'],
+            'task': entry['task'],
+        }) + '\n'
+
+    def _replay(self):
+        f = open(self._path)
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Probably cut short when the last run died.
+                    logging.debug("Ignoring bad journal line %r", line)
+                    continue
+                key = (record['rest_path'], record['checksum'])
+                self._entries[key] = {
+                    'state': record['state'],
+                    'task': record['task'],
+                }
+        finally:
+            f.close()
+
+    def _compact(self):
+        tmp_path = self._path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            for key, entry in self._entries.items():
+                f.write(self._format(key, entry))
+        finally:
+            f.close()
+        os.rename(tmp_path, self._path)
+
+def resume_tasks(session, journal, poll_policy=None):
+    '''
+    Wait for associate tasks that an earlier run submitted but never saw
+    finish, and record how they ended. Returns the number that succeeded.
+    '''
+    resumed = []
+    for key, task_link in journal.get_submitted():
+        task_uri = make_local_uri(get_rest_path(task_link))
+        resp = session.get(task_uri, params=TaskPollPolicy.POLL_PARAMS)
+        if resp.status_code == 404:
+            logging.info("Task %s from earlier run is gone, will redo", task_link)
+            journal.record_key(key, ImportJournal.FAILED)
+            continue
+        check_http_response(resp)
+        resumed.append((key, task_uri))
+
+    if not resumed:
+        return 0
+
+    logging.info("Resuming %d associate tasks from earlier run", len(resumed))
+
+    success_count = 0
+    for key, final_task, stats in run_tasks(
+            session, None, [], len(resumed), poll_policy, resumed):
+        if stats.timed_out:
+            continue
+        if final_task['status'] == 'FINISHED':
+            journal.record_key(key, ImportJournal.FINISHED)
+            success_count += 1
+        else:
+            journal.record_key(key, ImportJournal.FAILED)
+
+    return success_count
+
+# Marks the end of the items passed through an ImportPipeline queue.
+PIPELINE_STOP = object()
+
+def iter_queue(q, stop_event, wait=.1):
+    '''
+    Generate items from a pipeline queue until PIPELINE_STOP arrives or
+    stop_event is set. None is generated whenever nothing arrives within
+    wait seconds, so that the consumer can get on with other work.
+    '''
+    while not stop_event.isSet():
+        try:
+            item = q.get(timeout=wait)
+        except Queue.Empty:
+            yield None
+            continue
+
+        if item is PIPELINE_STOP:
+            return
+
+        yield item
+
+class ImportPipeline(object):
+    '''
+    Runs fetch_files and associate_files for one BIG-IP as overlapping stages
+    joined by bounded queues, so that association starts as soon as the first
+    batch of files is on disk instead of after the last one.
+
+    Discovered file objects are fed to settings.fetch_workers threads, each of
+    which downloads whatever is waiting, up to settings.fetch_batch files, in
+    one transfer. Downloaded files go straight on to associate_files, which
+    keeps settings.tasks_in_flight tasks running.
+    '''
+
+    QUEUE_SIZE = 1000
+
+    def __init__(self, session, bigip_connection, settings, journal=None):
+        self._session = session
+        self._conn = bigip_connection
+        self._settings = settings
+        self._journal = journal
+        self._fetch_queue = Queue.Queue(self.QUEUE_SIZE)
+        self._associate_queue = Queue.Queue(self.QUEUE_SIZE)
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._fetchers_running = 0
+        # rest_paths of the files associated, and of those whose task was
+        # still running when its poll timed out
+        self.associated = set()
+        self.still_running = set()
+
+    def run(self, file_objects):
+        '''
+        Push the given file objects through the pipeline. Returns the number
+        associated successfully.
+        '''
+        threads = [self._start_thread(self._feed, file_objects)]
+
+        self._fetchers_running = self._settings.fetch_workers
+        for _ in range(self._settings.fetch_workers):
+            threads.append(self._start_thread(self._fetch))
+
+        try:
+            return associate_files(
+                self._session,
+                iter_queue(self._associate_queue, self._stop_event),
+                self._settings.tasks_in_flight,
+                self._settings.poll_policy,
+                self._journal,
+                self._record_done)
+        finally:
+            # Releases the other stages if association failed part way.
+            self._stop_event.set()
+            for t in threads:
+                t.join()
+
+    def _record_done(self, f, succeeded, timed_out):
+        if succeeded:
+            self.associated.add(f.rest_path)
+        elif timed_out:
+            self.still_running.add(f.rest_path)
+
+    def _start_thread(self, target, *args):
+        t = threading.Thread(
+            target=target,
+            args=args,
+            name=threading.currentThread().getName())
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def _put(self, q, item):
+        while not self._stop_event.isSet():
+            try:
+                q.put(item, timeout=.5)
+                return
+            except Queue.Full:
+                pass
+
+    def _feed(self, file_objects):
+        try:
+            for f in file_objects:
+                self._put(self._fetch_queue, f)
+        finally:
+            for _ in range(self._settings.fetch_workers):
+                self._put(self._fetch_queue, PIPELINE_STOP)
+
+    def _fetch(self):
+        try:
+            stopped = False
+            while not stopped:
+                batch = []
+                for f in iter_queue(self._fetch_queue, self._stop_event):
+                    if f is not None:
+                        batch.append(f)
+                    if len(batch) >= self._settings.fetch_batch or (
+                            f is None and batch):
+                        break
+                else:
+                    stopped = True
+
+                if batch:
+                    self._fetch_batch(batch)
+        finally:
+            self._lock.acquire()
+            try:
+                self._fetchers_running -= 1
+                last = self._fetchers_running == 0
+            finally:
+                self._lock.release()
+
+            if last:
+                self._put(self._associate_queue, PIPELINE_STOP)
+
+    def _fetch_batch(self, batch):
+        try:
+            fetched = fetch_files(
+                self._conn, batch, self._settings.file_cache, self._journal)
+        except Exception:
+            logging.exception("Failed to download %d files", len(batch))
+            return
+
+        for f in fetched:
+            self._put(self._associate_queue, f)
+
+class ImportSettings(object):
+    '''
+    Options which apply to importing from every BIG-IP in a run.
+    '''
+
+    def __init__(self, port=None, batch_mode=False, tasks_in_flight=1,
+                 poll_policy=None, file_cache=None, fetch_workers=1,
+                 fetch_batch=100, journal_dir=None):
+        self.port = port
+        self.batch_mode = batch_mode
+        self.tasks_in_flight = tasks_in_flight
+        self.poll_policy = poll_policy
+        self.file_cache = file_cache
+        self.fetch_workers = fetch_workers
+        self.fetch_batch = fetch_batch
+        self.journal_dir = journal_dir
+
+class DeviceResult(object):
+    '''
+    Outcome of importing from a single BIG-IP, used for the fleet summary.
+    '''
+
+    def __init__(self, address):
+        self.address = address
+        self.found = 0
+        self.claimed = 0
+        self.associated = 0
+        self.resumed = 0
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.associated == self.claimed
+
+def import_device(session, inventory, address, settings):
+    '''
+    Import all unmanaged file objects that can be found on one BIG-IP. Errors
+    are recorded in the returned DeviceResult rather than raised, so that one
+    bad device doesn't stop the rest of the fleet.
+    '''
+    result = DeviceResult(address)
+    start = time.time()
+    journal = None
+    pipeline = None
+    claimed_files = []
+
+    try:
+        if settings.journal_dir is not None:
+            journal = ImportJournal(settings.journal_dir, address)
+            result.resumed = resume_tasks(session, journal, settings.poll_policy)
+
+        with SshConnection(address, settings.port, settings.batch_mode) as conn:
+            unmanaged_files = find_all_unmanaged_objects(
+                session, conn, inventory)
+            result.found = len(unmanaged_files)
+
+            # Another BIG-IP may already be importing some of these.
+            for f in unmanaged_files:
+                if (journal is not None and
+                        journal.get_state(f) == ImportJournal.FINISHED):
+                    logging.debug(
+                        "%s %s already imported by an earlier run, skipping",
+                        f.obj_type.display_name,
+                        f.fullpath)
+                elif (journal is not None and
+                        journal.get_state(f) == ImportJournal.SUBMITTED):
+                    # Its task outlived the resume wait; importing it again
+                    # would submit a second task for the same object.
+                    logging.info(
+                        "%s %s has an associate task from an earlier run still "
+                        "running, skipping",
+                        f.obj_type.display_name,
+                        f.fullpath)
+                elif inventory.claim(f.rest_path):
+                    claimed_files.append(f)
+                else:
+                    logging.debug(
+                        "%s %s already claimed by another BIG-IP, skipping",
+                        f.obj_type.display_name,
+                        f.fullpath)
+            result.claimed = len(claimed_files)
+
+            if claimed_files:
+                pipeline = ImportPipeline(session, conn, settings, journal)
+                result.associated = pipeline.run(claimed_files)
+            else:
+                logging.info("No files found to import")
+    except Exception, e:
+        logging.exception("Import from BIG-IP %s failed", address)
+        result.error = str(e) or e.__class__.__name__
+
+    # Whatever this BIG-IP failed to fetch or associate is left for another
+    # one holding the same object. Objects whose task may still be running on
+    # BIG-IQ stay claimed so they aren't associated twice.
+    done = set()
+    if pipeline is not None:
+        done = pipeline.associated | pipeline.still_running
+    released = [f for f in claimed_files if f.rest_path not in done]
+    for f in released:
+        inventory.release(f.rest_path)
+    if released:
+        logging.info(
+            "Released %d files for other BIG-IPs to import", len(released))
+
+    if journal is not None:
+        if result.succeeded and not journal.get_submitted():
+            journal.remove()
+        else:
+            journal.close()
+
+    result.elapsed = time.time() - start
+    return result
+
+def read_device_file(path):
+    '''
+    Read BIG-IP addresses from a file, one per line. Blank lines and lines
+    starting with # are ignored.
+    '''
+    devices = []
+    f = open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                devices.append(line)
+    finally:
+        f.close()
+
+    return devices
+
+def run_fleet(inventory, devices, settings, workers=1):
+    '''
+    Import from each of the given BIG-IPs using a bounded pool of worker
+    threads, each holding at most one ssh master connection at a time.
+    Returns a list of DeviceResult in the same order as devices.
+    '''
+    work = Queue.Queue()
+    for index, address in enumerate(devices):
+        work.put((index, address))
+
+    results = [None] * len(devices)
+
+    def worker():
+        # requests.Session isn't documented as thread-safe, so each worker
+        # gets its own.
+        session = requests.Session()
+        while True:
+            try:
+                index, address = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            threading.currentThread().setName(address)
+            logging.info("Importing from BIG-IP %s", address)
+            results[index] = import_device(
+                session, inventory, address, settings)
+
+    threads = []
+    for _ in range(min(workers, len(devices))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        # join() without a timeout can't be interrupted with Ctrl-C.
+        while t.isAlive():
+            t.join(1)
+
+    return results
+
+def log_fleet_summary(results):
+    logging.info("Import summary:")
+    for r in results:
+        if r.error is not None:
+            status = 'ERROR: %s' % r.error
+        elif r.succeeded:
+            status = 'OK'
+        else:
+            status = 'INCOMPLETE'
+
+        logging.info(
+            "  %s: found %d, imported %d of %d claimed, resumed %d, %.1fs, %s",
+            r.address,
+            r.found,
+            r.associated,
+            r.claimed,
+            r.resumed,
+            r.elapsed,
+            status)
+
+    failed = len([r for r in results if not r.succeeded])
+    logging.info(
+        "%d of %d BIG-IPs imported successfully",
+        len(results) - failed,
+        len(results))
 
 def parse_arguments(args):
     parser = argparse.ArgumentParser(
@@ -593,10 +1898,55 @@ def parse_arguments(args):
             "The target BIG-IP will be accessed over ssh using the BIG-IP root",
             "account. Enter the root user's password if prompted.",
             "",
-            "Repeat with additional target BIG-IPs to import more file objects.",
+            "Several BIG-IPs may be given, on the command line or with",
+            "--device-file, to import from all of them in one run. With more",
+            "than one worker, ssh runs in batch mode and password prompts are",
+            "disabled, so set up key-based root access to the BIG-IPs first.",
         ]))
 
-    parser.add_argument('bigip', help='address of BIG-IP to import SSL Cert, Key & CRL from')
+    parser.add_argument(
+        'bigip',
+        nargs='*',
+        help='address of BIG-IP to import SSL Cert, Key & CRL from')
+    parser.add_argument(
+        '--device-file', '-f',
+        help='file listing BIG-IP addresses to import from, one per line')
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=1,
+        help='number of BIG-IPs to import from concurrently (default: %(default)s)')
+    parser.add_argument(
+        '--tasks-in-flight', '-t',
+        type=int,
+        default=1,
+        help='number of associate tasks to run at once per BIG-IP (default: %(default)s)')
+    parser.add_argument(
+        '--fetch-workers',
+        type=int,
+        default=1,
+        help='number of concurrent file transfers per BIG-IP (default: %(default)s)')
+    parser.add_argument(
+        '--fetch-batch',
+        type=int,
+        default=100,
+        help='maximum number of files in each transfer (default: %(default)s)')
+    parser.add_argument(
+        '--task-timeout',
+        type=float,
+        default=600.0,
+        help='seconds to wait for each associate task, 0 to wait forever (default: %(default)s)')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=256,
+        help=('megabytes of downloaded files to keep in %s for later runs, '
+              '0 to disable (default: %%(default)s)' % FILE_CACHE_DIR))
+    parser.add_argument(
+        '--no-journal',
+        action='store_true',
+        help=('don\'t record progress in %s for resuming an interrupted run'
+              % JOURNAL_DIR))
     parser.add_argument('--log-file', '-l', help='log to the given file name')
     parser.add_argument(
         '--log-level',
@@ -610,7 +1960,41 @@ def parse_arguments(args):
     # unmanaged on BIG-IQ, so it's not clear that it would be useful. The user
     # can opt out of certain files by removing the object from BIG-IQ.
 
-    return parser.parse_args(args)
+    arguments = parser.parse_args(args)
+
+    if arguments.device_file:
+        arguments.bigip += read_device_file(arguments.device_file)
+
+    # Each address once, in the order given: two workers on the same host
+    # would share one ssh ControlPath.
+    devices = []
+    for address in arguments.bigip:
+        if address not in devices:
+            devices.append(address)
+    arguments.bigip = devices
+
+    if not arguments.bigip:
+        parser.error('no BIG-IP address given')
+
+    if arguments.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if arguments.tasks_in_flight < 1:
+        parser.error('--tasks-in-flight must be at least 1')
+
+    if arguments.fetch_workers < 1:
+        parser.error('--fetch-workers must be at least 1')
+
+    if arguments.fetch_batch < 1:
+        parser.error('--fetch-batch must be at least 1')
+
+    if arguments.task_timeout < 0:
+        parser.error('--task-timeout must not be negative')
+
+    if arguments.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+
+    return arguments
 
 ################################################################################
 #
@@ -629,21 +2013,47 @@ def main(args=None):
     if arguments.log_level:
         loglevel = getattr(logging, arguments.log_level.upper())
 
+    if len(arguments.bigip) > 1:
+        # Interleaved output from several BIG-IPs needs to say which is which.
+        log_format = '%(asctime)s:%(levelname)s:%(threadName)s:%(message)s'
+    else:
+        log_format = '%(asctime)s:%(levelname)s:%(message)s'
+
     logging.basicConfig(
         filename=arguments.log_file,
         level=loglevel,
-        format='%(asctime)s:%(levelname)s:%(message)s')
+        format=log_format)
 
     session = requests.Session()
 
-    with SshConnection(arguments.bigip, arguments.port) as conn:
-        unmanaged_files = find_all_unmanaged_objects(session, conn)
+    inventory = BigiqInventory(session)
 
-        if unmanaged_files:
-            fetch_files(conn, unmanaged_files)
-            associate_files(session, unmanaged_files)
-        else:
-            logging.info("No files found to import")
+    file_cache = None
+    if arguments.cache_size:
+        file_cache = FileCache(FILE_CACHE_DIR, arguments.cache_size * 1024 * 1024)
+
+    settings = ImportSettings(
+        port=arguments.port,
+        batch_mode=arguments.workers > 1,
+        tasks_in_flight=arguments.tasks_in_flight,
+        poll_policy=TaskPollPolicy(deadline=arguments.task_timeout or None),
+        file_cache=file_cache,
+        fetch_workers=arguments.fetch_workers,
+        fetch_batch=arguments.fetch_batch,
+        journal_dir=None if arguments.no_journal else JOURNAL_DIR)
+
+    results = run_fleet(inventory, arguments.bigip, settings, arguments.workers)
+
+    log_fleet_summary(results)
+
+    if file_cache is not None:
+        logging.info(
+            "File cache: %d hits, %d misses",
+            file_cache.hits,
+            file_cache.misses)
+
+    if [r for r in results if not r.succeeded]:
+        return 1
 
     return 0
 
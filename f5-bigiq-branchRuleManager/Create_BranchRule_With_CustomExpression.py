@@ -17,8 +17,13 @@
 #################################################################################
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-import json, getpass, sys, os, re
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
+import argparse, copy, csv, json, getpass, sys, os, re, threading, time, Queue
 
 ## CHANGE QUEUE
 # 03/14/2019: v1.0  K.Rana@f5.com     Initial version
@@ -26,41 +31,134 @@ import json, getpass, sys, os, re
 ## DESCRIPTION
 # Script for adding and modifying branch rule with advanced expression to access policy
 
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(
+        description='Add and modify branch rules with advanced expressions in BIG-IQ access policies.')
+    parser.add_argument(
+        '--manifest',
+        help=('CSV file of changes to apply without prompting, with columns group, '
+              'policy, item, action (modify or create), branch and expression'))
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help='number of policy items to update at once with --manifest (default: %(default)s)')
+    parser.add_argument(
+        '--coordinated',
+        action='store_true',
+        help=('stage all changes to a policy under one coordination task and '
+              'commit them together, instead of committing every change on its own'))
+    parser.add_argument(
+        '--commit-timeout',
+        type=float,
+        default=600,
+        help='seconds to wait for BIG-IQ to commit a coordination task (default: %(default)s)')
+    arguments = parser.parse_args(args)
+    if arguments.workers < 1:
+        parser.error('--workers must be at least 1')
+    return arguments
+
+arguments = parse_arguments(sys.argv[1:])
+
 print "\n\n\nThis script will allow you to set advacnced expression for branch rules in access policies (per-session and per-request)"  
 
 print "\n\n======================================================  ATTENTION  =================================================================="
 print "PLEASE MAKE SURE THE POLICY YOU WANT TO MODIFY IS NOT IN DRAFT MODE. MAKE SURE YOU HAVE SAVED YOUR POLICY BEFORE RUNNING THIS SCRIPT."  
 print "=====================================================================================================================================\n"
 ACCESS_API = "https://localhost/mgmt/cm/access/working-config/apm/policy/access-policy/"
+POLICY_ITEM_API = "https://localhost/mgmt/cm/access/working-config/apm/policy/policy-item/"
+DEVICE_GROUP_API = "https://localhost/mgmt/shared/resolver/device-groups/"
+
+URL_COORDINATOR = "https://localhost/mgmt/shared/coordinator/"
+# Interactive edits can take a while, so the task gets longer than the
+# orphan cleaner's before BIG-IQ drops it
+REQ_PAYLOAD_COORDINATOR = {"description":"branchRuleTask","timeoutInSeconds":1800}
+COORDINATOR_FINAL_STAGES = ["COMPLETED", "FAILED", "CANCELED"]
+
+MANIFEST_FIELDS = ["group", "policy", "item", "action", "branch", "expression"]
+MANIFEST_ACTIONS = {"modify": "modify", "m": "modify", "create": "create", "c": "create"}
+# Names per filtered query when resolving a manifest
+FILTER_BATCH = 50
+# Times an edit is reapplied to a freshly fetched item after a conflicting PUT
+MAX_CONFLICT_RETRIES = 3
+
+# Transient restjavad errors on idempotent calls are retried
+RETRY_STATUSES = [500, 502, 503, 504]
+RETRY_METHODS = ["GET", "PUT", "DELETE"]
+
+# urllib3 renamed method_whitelist to allowed_methods; with neither available
+# only failed connections are retried
+def make_retry(total):
+    if Retry is None:
+        return total
+    for methods_option in ("allowed_methods", "method_whitelist"):
+        options = {"total": total,
+                   "backoff_factor": 0.5,
+                   "status_forcelist": RETRY_STATUSES,
+                   "raise_on_status": False,
+                   methods_option: RETRY_METHODS}
+        try:
+            return Retry(**options)
+        except TypeError:
+            pass
+    return total
+
+# One keep-alive session for every REST call so the PUTs of an editing session
+# and the coordination task polls reuse connections instead of reconnecting
+# each time
+class BigIqClient(object):
+    def __init__(self, auth, pool_size=4, retries=3):
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry(retries))
+        self.session.mount("https://", adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.session.put(url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.session.patch(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.session.delete(url, **kwargs)
+
 print "\nAuthentication Information: "
 auth = HTTPBasicAuth(raw_input("Username: "), getpass.getpass())
+client = BigIqClient(auth, pool_size=max(4, arguments.workers))
 
 
 def post_profile_policy_request(url,req_payload,coordinator_id):
-    response = requests.post(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id}, auth=auth, verify=False)
+    response = client.post(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id})
     return response, response.json()
 
 def get_request(url):
-    response = requests.get(url, auth=auth, verify=False)
+    response = client.get(url)
     response_json = response.json()
     return response_json
 
 def get_request_query(url,params):
-    response = requests.get(url, params=params, auth=auth, verify=False)
+    response = client.get(url, params=params)
     response_json = response.json()
     return response_json
 
 def get_request_query_comp(url, params):
-    response = requests.get(url, params=params, auth=auth, verify=False)
+    response = client.get(url, params=params)
     response_json = response.json()
     return response, response_json
 
 def put_request(url,req_payload,coordinator_id=None):
 
     if coordinator_id == None:
-        response = requests.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json"}, auth=auth, verify=False)
+        response = client.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json"})
     else:
-        response = requests.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id}, auth=auth, verify=False)
+        response = client.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id})
 
     response_json = response.json()
     return response_json
@@ -68,20 +166,236 @@ def put_request(url,req_payload,coordinator_id=None):
 def put_request_comp(url,req_payload,coordinator_id=None):
 
     if coordinator_id == None:
-        response = requests.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json"}, auth=auth, verify=False)
+        response = client.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json"})
     else:
-        response = requests.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id}, auth=auth, verify=False)
+        response = client.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id})
 
     response_json = response.json()
     return response, response_json
 
-def process_item(item, postfix):
+# Policy items seen during this run, by selfLink. Access policies are fetched
+# with itemList/nameReference expanded, which already carries every item, so
+# listing a policy and editing its items needs no GET per item. Our own PUTs
+# drop the cached item and keep the PUT response as its new state.
+class PolicyItemCache(object):
+    def __init__(self):
+        self.items = {}
+
+    def add(self, item):
+        self.items[item["selfLink"]] = item
+
+    # Items embedded in an access policy fetched with
+    # $expand=itemList/nameReference; unexpanded references only hold a link.
+    # The reference's own link is dropped so it isn't sent back on a PUT.
+    def add_expanded(self, policy):
+        for entry in policy.get("itemList", []):
+            reference = entry.get("nameReference", {})
+            if "selfLink" in reference and "caption" in reference:
+                item = dict(reference)
+                item.pop("link", None)
+                self.add(item)
+
+    def get(self, link):
+        if link not in self.items:
+            self.items[link] = get_request(link)
+        return self.items[link]
+
+    # A copy to edit, so the cached item only changes once a PUT succeeds
+    def get_copy(self, link):
+        return copy.deepcopy(self.get(link))
+
+    # A PUT staged under a coordination task isn't visible to a plain GET
+    # until the task commits, so a staged item stays cached as it was sent
+    # (or as the response returned it); PolicyTransaction drops it again if
+    # the commit fails
+    def put(self, link, policy_item, coordinator_id=None):
+        self.invalidate(link)
+        res = put_request_comp(link, policy_item, coordinator_id)
+        if res[0].status_code == 200 and "selfLink" in res[1]:
+            self.add(res[1])
+        elif res[0].status_code == 202 and coordinator_id is not None:
+            self.add(copy.deepcopy(policy_item))
+        return res
+
+    def invalidate(self, link):
+        self.items.pop(link, None)
+
+item_cache = PolicyItemCache()
+
+# The ending new branches lead to unless another is chosen
+def get_ending_postfix(policy):
+    if policy["type"] == "access-policy":
+        return "_end_deny"
+    return "_end_reject"
+
+# The ending items of one access policy by name and by caption, built once
+# when the policy is loaded so creating a branch doesn't have to query the
+# policy-item collection for its ending
+class PolicyEndings(object):
+    def __init__(self, policy):
+        self.group = policy["deviceGroupReference"]["link"].rsplit("/", 1)[-1]
+        self.default_name = policy["name"] + get_ending_postfix(policy)
+        self.by_name = {}
+        self.by_caption = {}
+        for entry in policy.get("itemList", []):
+            link = entry["nameReference"]["link"]
+            item = item_cache.items.get(link)
+            if entry["name"][len(policy["name"]):].startswith("_end_") or (item is not None and item.get("itemType") == "ending"):
+                self.by_name[entry["name"]] = link
+                if item is not None and "caption" in item:
+                    self.by_caption[item["caption"]] = link
+
+    def default_caption(self):
+        link = self.by_name.get(self.default_name)
+        if link in item_cache.items and "caption" in item_cache.items[link]:
+            return item_cache.items[link]["caption"]
+        return self.default_name
+
+    # Link of the ending with this caption, or of the default ending when
+    # caption is empty. Only a default ending missing from itemList is looked
+    # up, once.
+    def get_link(self, caption=None):
+        if caption:
+            return self.by_caption.get(caption)
+        if self.default_name not in self.by_name:
+            DENY_POLICY_FILTER = {"$filter" : "'deviceGroupReference/link' eq '" + DEVICE_GROUP_API + self.group + "' and 'name' eq '" + self.default_name + "'"}
+            denyPolicyItems = get_request_query(POLICY_ITEM_API, DENY_POLICY_FILTER)
+            if len(denyPolicyItems.get("items", [])) == 0:
+                return None
+            self.by_name[self.default_name] = denyPolicyItems["items"][0]["selfLink"]
+        return self.by_name[self.default_name]
+
+# PolicyEndings by access policy selfLink
+ending_index = {}
+
+def get_policy_endings(policy):
+    if policy["selfLink"] not in ending_index:
+        ending_index[policy["selfLink"]] = PolicyEndings(policy)
+    return ending_index[policy["selfLink"]]
+
+def patch_coordinator(coordinator_id):
+    payload = {"id": coordinator_id, "isCommit": True, "stage": "UPDATING"}
+    response = client.patch(URL_COORDINATOR + coordinator_id, data=json.dumps(payload), headers={"content-type":"application/json"})
+    return response.json()
+
+# Poll a coordination task until it reaches a final stage, backing off between
+# polls, for at most timeout seconds. Returns the last stage seen.
+def wait_for_coordinator(coordinator_id, coordinator, timeout, initial_interval=0.25, max_interval=5.0):
+    start = time.time()
+    interval = initial_interval
+    while coordinator.get("stage") not in COORDINATOR_FINAL_STAGES:
+        if coordinator.get("stage") is None or time.time() - start >= timeout:
+            break
+        time.sleep(interval)
+        interval = min(interval * 1.5, max_interval)
+        coordinator = get_request(URL_COORDINATOR + coordinator_id)
+    return coordinator.get("stage")
+
+# Changes to one access policy staged under a single coordination task and
+# committed together, so BIG-IQ commits and re-evaluates the policy once
+# rather than once per changed item
+class PolicyTransaction(object):
+    def __init__(self):
+        res = post_profile_policy_request(URL_COORDINATOR, REQ_PAYLOAD_COORDINATOR, None)
+        self.coordinator_id = res[1]["id"]
+        self.links = set()
+        self.edits = {}
+
+    def put(self, link, policy_item):
+        self.links.add(link)
+        return item_cache.put(link, policy_item, self.coordinator_id)
+
+    # Remember an edit that was staged, so it can be replayed if a later
+    # PUT of the same item conflicts
+    def record(self, link, edit):
+        self.edits.setdefault(link, []).append(edit)
+
+    # A refetched item only holds what's committed; reapply the edits already
+    # staged for it so the retried PUT doesn't drop them
+    def replay(self, link, policy_item):
+        for edit in self.edits.get(link, []):
+            edit(policy_item)
+
+    # Returns the final stage, COMPLETED on success. If the commit didn't
+    # complete, the cached items hold staged changes that never landed, so
+    # they are dropped.
+    def commit(self, timeout):
+        start = time.time()
+        stage = wait_for_coordinator(self.coordinator_id, patch_coordinator(self.coordinator_id), timeout)
+        print "Coordination task %s %s after %.1fs" % (self.coordinator_id, stage, time.time() - start)
+        if stage != "COMPLETED":
+            for link in self.links:
+                item_cache.invalidate(link)
+        return stage
+
+# Whether a PUT was refused because the item changed since it was read
+def is_conflict(res):
+    if res[0].status_code in (409, 412):
+        return True
+    return res[0].status_code == 400 and "generation" in str(res[1].get("message", "")).lower()
+
+# Read-modify-write of a policy item without a GET up front. edit changes the
+# cached copy in place, which still carries the generation it was read at, and
+# the PUT sends that generation back so BIG-IQ refuses the update if someone
+# else changed the item meanwhile. On a conflict the item is fetched again and
+# edit reapplied to it. Within a transaction the refetched item is the
+# committed state, so the edits already staged for it are replayed first and
+# the retried PUT keeps them. edit returns False when there's nothing to PUT,
+# in which case None is returned instead of the PUT result.
+def update_item(link, edit, transaction=None):
+    policy_item = item_cache.get_copy(link)
+    if "generation" not in policy_item:
+        item_cache.invalidate(link)
+        policy_item = item_cache.get_copy(link)
+
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        if not edit(policy_item):
+            return None
+        if transaction is None:
+            res = item_cache.put(link, policy_item)
+        else:
+            res = transaction.put(link, policy_item)
+            if res[0].status_code in (200, 202):
+                transaction.record(link, edit)
+        if attempt == MAX_CONFLICT_RETRIES or not is_conflict(res):
+            return res
+        # put() already dropped the stale item, so this fetches the current one
+        policy_item = item_cache.get_copy(link)
+        if transaction is not None:
+            transaction.replay(link, policy_item)
+
+# Edits for update_item. The rule to modify is the one at index of the rules
+# captioned as in captions, which is what the user chose from. If a refetched
+# item's rules have changed since, it is found by caption instead, as long as
+# only one rule has that caption.
+def modify_rule_edit(index, captions, expression):
+    def edit(policy_item):
+        rules = policy_item["rules"]
+        if [rule["caption"] for rule in rules] == captions:
+            rules[index]["expression"] = expression
+            return True
+        matches = [rule for rule in rules if rule["caption"] == captions[index]]
+        if len(matches) != 1:
+            return False
+        matches[0]["expression"] = expression
+        return True
+    return edit
+
+def add_rule_edit(new_rule):
+    def edit(policy_item):
+        if [rule for rule in policy_item["rules"] if rule["caption"] == new_rule["caption"]]:
+            return False
+        policy_item["rules"].append(copy.deepcopy(new_rule))
+        return True
+    return edit
+
+def process_item(item, endings, transaction=None):
     link = item["nameReference"]["link"]
 
     # print "Link is: " + link
 
     # get policy item
-    policyItem = get_request(link)
+    policyItem = item_cache.get_copy(link)
 
     action = raw_input("\nWhich operation you want to perform? \nModify branch (m) \nCreate new branch (c) \nExit (e) \n\nPlease enter (m/c/e): ")
 
@@ -101,6 +415,7 @@ def process_item(item, postfix):
         while not 0 < ruleIndex <= len(policyItem["rules"]):
             ruleIndex = input("Out of Range, Please Enter Again: ")
 
+        ruleCaptions = [rule["caption"] for rule in policyItem["rules"]]
         ruleItem = policyItem["rules"][ruleIndex-1]
 
         # in case no expression in this rule, add property first
@@ -113,10 +428,14 @@ def process_item(item, postfix):
         newExpr = raw_input("Enter new advanced expression: ")
         ruleItem["expression"] = newExpr
 
-        res = put_request_comp(link, policyItem)
+        res = update_item(link, modify_rule_edit(ruleIndex-1, ruleCaptions, newExpr), transaction)
 
         print "\nModifying Branch: ", ruleItem["caption"], "\tNew advanced expression: ", ruleItem["expression"]
-        if res[0].status_code == 200:
+        if res is None:
+            print "Result: FAILED, someone else changed the branches and this one can no longer be identified"
+        elif res[0].status_code in (200, 202) and transaction is not None:
+            print "Result: STAGED, committed when you finish editing this policy"
+        elif res[0].status_code == 200:
             print "Result: SUCCESS"
         else:
             print "Result: FAILED"
@@ -133,27 +452,274 @@ def process_item(item, postfix):
 
         newRule = {"caption": caption, "expression": expression}
 
-        denyPolicyName = policyName + postfix
-        DENY_POLICY_FILTER = {"$filter" : "'deviceGroupReference/link' eq 'https://localhost/mgmt/shared/resolver/device-groups/" + accessGroup + "' and 'name' eq '" + denyPolicyName + "'"}
-        POLICY_API = "https://localhost/mgmt/cm/access/working-config/apm/policy/policy-item/"
-
-        denyPolicyItems = get_request_query(POLICY_API, DENY_POLICY_FILTER)
-        selfLink = denyPolicyItems["items"][0]["selfLink"]
+        endingCaption = raw_input("Please enter the caption of the ending for the new branch (press Enter for " + endings.default_caption() + "): ")
+        selfLink = endings.get_link(endingCaption)
+        if selfLink is None:
+            print "\nNo ending ", endingCaption or endings.default_name, " in this policy"
+            print "Result: FAILED"
+            return False
 
         newRule["nextItemReference"] = {"link": selfLink}
 
-        policyItem["rules"].append(newRule)
-
-        res = put_request_comp(link, policyItem)
+        res = update_item(link, add_rule_edit(newRule), transaction)
 
         print "\nCreating Branch: ", newRule["caption"], "\tAdvanced Expression: ", newRule["expression"]
-        if res[0].status_code == 200:
+        if res is None:
+            print "Result: FAILED, a branch with this name already exists"
+        elif res[0].status_code in (200, 202) and transaction is not None:
+            print "Result: STAGED, committed when you finish editing this policy"
+        elif res[0].status_code == 200:
             print "Result: SUCCESS"
         else:
             print "Result: FAILED"
             print res[1]
 
 
+###############
+# Batch mode
+###############
+
+# A row of the change manifest and, once applied, its result
+class BranchChange(object):
+    def __init__(self, number, row):
+        self.number = number
+        self.group = (row.get("group") or "").strip()
+        self.policy = (row.get("policy") or "").strip()
+        self.item = (row.get("item") or "").strip()
+        self.action = MANIFEST_ACTIONS.get((row.get("action") or "").strip().lower())
+        self.branch = (row.get("branch") or "").strip()
+        self.expression = row.get("expression") or ""
+        self.ending = (row.get("ending") or "").strip()
+        self.item_key = None
+        self.result = None
+
+        if self.action is None:
+            self.result = "FAILED: action must be modify or create"
+        elif not (self.group and self.policy and self.item and self.branch):
+            self.result = "FAILED: group, policy, item and branch are required"
+
+def read_manifest(path):
+    with open(path) as manifest:
+        reader = csv.DictReader(manifest)
+        missing = [field for field in MANIFEST_FIELDS if field not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("Manifest is missing column(s): " + ", ".join(missing))
+        return [BranchChange(number, row) for number, row in enumerate(reader, 1)]
+
+# Yield every object in the collection at url that belongs to group and has
+# one of names, using one filtered query per FILTER_BATCH names
+def query_by_name(url, group, names, params=None):
+    names = sorted(names)
+    for start in range(0, len(names), FILTER_BATCH):
+        batch = names[start:start + FILTER_BATCH]
+        query = dict(params or {})
+        query["$filter"] = ("'deviceGroupReference/link' eq '" + DEVICE_GROUP_API + group + "' and (" +
+                            " or ".join("'name' eq '%s'" % name for name in batch) + ")")
+        res = get_request_query(url, query)
+        for item in res.get("items", []):
+            yield item
+
+# Find the policy item each change applies to. The access policies of each
+# group are fetched with one query (per FILTER_BATCH names) with their items
+# expanded; only items the expansion didn't carry are queried for, again in
+# bulk, rather than walking policies and items one GET at a time.
+def resolve_changes(changes):
+    policy_names = {}
+    for change in changes:
+        if change.result is None:
+            policy_names.setdefault(change.group, set()).add(change.policy)
+
+    policies = {}
+    for group, names in policy_names.items():
+        for policy in query_by_name(ACCESS_API, group, names, {"$expand": "itemList/nameReference"}):
+            policies[(group, policy["name"])] = policy
+            item_cache.add_expanded(policy)
+
+    # The _act_ items and the endings of every policy
+    items = {}
+    missing_names = {}
+    for (group, name), policy in policies.items():
+        for entry in policy.get("itemList", []):
+            if entry["name"][len(name):].startswith(("_act_", "_end_")):
+                link = entry["nameReference"]["link"]
+                if link in item_cache.items:
+                    items[(group, entry["name"])] = item_cache.items[link]
+                else:
+                    missing_names.setdefault(group, set()).add(entry["name"])
+
+    for group, names in missing_names.items():
+        for item in query_by_name(POLICY_ITEM_API, group, names):
+            item_cache.add(item)
+            items[(group, item["name"])] = item
+
+    for change in changes:
+        if change.result is not None:
+            continue
+
+        policy = policies.get((change.group, change.policy))
+        if policy is None:
+            change.result = "FAILED: policy not found"
+            continue
+
+        for entry in policy.get("itemList", []):
+            key = (change.group, entry["name"])
+            if (entry["name"][len(change.policy):].startswith("_act_") and key in items
+                    and items[key].get("caption") == change.item):
+                change.item_key = key
+                break
+        else:
+            change.result = "FAILED: policy item not found"
+            continue
+
+        if change.action == "create":
+            change.next_item_link = get_policy_endings(policy).get_link(change.ending)
+            if change.next_item_link is None:
+                change.result = "FAILED: no ending " + (change.ending or get_ending_postfix(policy)) + " for the new branch"
+                continue
+
+    return items
+
+# Apply every change for one policy item to it in manifest order, then PUT it
+# once, reapplying them to a fresh copy if the PUT conflicts. Changes that
+# can't be applied fail on their own without stopping the rest.
+def apply_item_changes(link, item_changes, transaction=None):
+    applied = []
+
+    def edit(policy_item):
+        del applied[:]
+        for change in item_changes:
+            change.result = None
+            rules = [rule for rule in policy_item["rules"] if rule["caption"] == change.branch]
+            if change.action == "modify":
+                if not rules:
+                    change.result = "FAILED: branch not found"
+                    continue
+                rules[0]["expression"] = change.expression
+            else:
+                if rules:
+                    change.result = "FAILED: branch already exists"
+                    continue
+                policy_item["rules"].append({"caption": change.branch,
+                                             "expression": change.expression,
+                                             "nextItemReference": {"link": change.next_item_link}})
+            applied.append(change)
+        return len(applied) > 0
+
+    try:
+        res = update_item(link, edit, transaction)
+    except (requests.exceptions.RequestException, ValueError), e:
+        for change in applied:
+            change.result = "FAILED: " + str(e)
+        return
+    if res is None:
+        return
+
+    # Staged changes may only be accepted at this point
+    if res[0].status_code == 200 or (res[0].status_code == 202 and transaction is not None):
+        result = "SUCCESS"
+    else:
+        result = "FAILED: HTTP %d %s" % (res[0].status_code, res[1].get("message", ""))
+    for change in applied:
+        change.result = result
+
+def print_change_table(changes):
+    header = ["#", "Group", "Policy", "Item", "Action", "Branch", "Result"]
+    rows = [[str(change.number), change.group, change.policy, change.item,
+             change.action or "", change.branch, change.result or "FAILED: not applied"] for change in changes]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header, ["-" * width for width in widths]] + rows:
+        print "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+
+# Stage every item's changes for one policy under a coordination task and
+# commit them together. A change only succeeds if its PUT was staged and the
+# commit completed.
+def apply_policy_changes(policy_items, timeout):
+    try:
+        transaction = PolicyTransaction()
+    except (requests.exceptions.RequestException, ValueError, KeyError), e:
+        for link, item_changes in policy_items:
+            for change in item_changes:
+                change.result = "FAILED: could not create coordination task: " + str(e)
+        return
+
+    for link, item_changes in policy_items:
+        apply_item_changes(link, item_changes, transaction)
+
+    # Nothing counts as applied until the commit completes
+    staged = [change for link, item_changes in policy_items
+              for change in item_changes if change.result == "SUCCESS"]
+    if not staged:
+        return
+    for change in staged:
+        change.result = "FAILED: not committed"
+    try:
+        stage = transaction.commit(timeout)
+    except (requests.exceptions.RequestException, ValueError), e:
+        stage = str(e)
+    for change in staged:
+        if stage == "COMPLETED":
+            change.result = "SUCCESS"
+        else:
+            change.result = "FAILED: commit %s" % stage
+
+# Apply a change manifest without prompting. Changes to different policy
+# items are PUT concurrently by a pool of workers; changes to the same item
+# are combined into a single PUT so they can't overwrite each other. With
+# coordinated set, a worker takes a whole policy instead and commits its
+# changes in one coordination task.
+def run_manifest(path, workers, coordinated=False, timeout=600):
+    changes = read_manifest(path)
+    items = resolve_changes(changes)
+
+    by_item = {}
+    for change in changes:
+        if change.result is None:
+            by_item.setdefault(change.item_key, []).append(change)
+
+    units = {}
+    for key, item_changes in by_item.items():
+        if coordinated:
+            unit_key = (item_changes[0].group, item_changes[0].policy)
+        else:
+            unit_key = key
+        units.setdefault(unit_key, []).append((items[key]["selfLink"], item_changes))
+
+    pending = Queue.Queue()
+    for policy_items in units.values():
+        pending.put(policy_items)
+
+    def worker():
+        while True:
+            try:
+                policy_items = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if coordinated:
+                apply_policy_changes(policy_items, timeout)
+            else:
+                for link, item_changes in policy_items:
+                    apply_item_changes(link, item_changes)
+
+    threads = []
+    for _ in range(min(workers, len(units))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    print ""
+    print_change_table(changes)
+
+    failed = [change for change in changes if change.result != "SUCCESS"]
+    print "\n%d change(s) applied, %d failed" % (len(changes) - len(failed), len(failed))
+    if failed:
+        return 1
+    return 0
+
+if arguments.manifest:
+    sys.exit(run_manifest(arguments.manifest, arguments.workers, arguments.coordinated, arguments.commit_timeout))
+
 while True:
     accessGroup = raw_input("\nPlease enter the Access Group name: ")
     policyName = raw_input("Please enter the policy name: ")
@@ -162,13 +728,16 @@ while True:
     print "\nPolicy Name: " + policyName
     try:
         res = get_request_query(ACCESS_API, params_find_policy)
+        for policy in res["items"]:
+            item_cache.add_expanded(policy)
+            get_policy_endings(policy)
         # print res
         if len(res["items"]) == 0:
             print "No policy found, please try again \n"
 
         else: 
             #rawItems = res["items"][0]["itemList"]
-            rawItems = list((subItem, item["type"]) for item in res["items"] for subItem in item["itemList"])
+            rawItems = list((subItem, item) for item in res["items"] for subItem in item["itemList"])
             items = list(filter(lambda i: i[0]["name"][len(policyName):].startswith("_act_"), rawItems))
             if len(items) == 0:
                 print "No valid policy found \n"
@@ -185,6 +754,11 @@ while True:
 
 # link = res["items"][0]["itemList"][0]["nameReference"]["link"]
 
+transaction = None
+if arguments.coordinated:
+    transaction = PolicyTransaction()
+    print "\nChanges to this policy are staged and committed together when you finish editing it."
+
 try:
     while True:
         print "\nThe Policy Item List: \n"
@@ -192,7 +766,7 @@ try:
         try:
             for i, item in enumerate(items):
                 # print i+1, item[0]["name"]
-                nameRes = get_request(item[0]["nameReference"]["link"])
+                nameRes = item_cache.get(item[0]["nameReference"]["link"])
                 print i+1, nameRes["caption"] 
         except ValueError:
             print "\nSome Errors Occur When Retrieving Policy Item, Please Try again\n"
@@ -202,11 +776,7 @@ try:
             itemIndex = input("\nOut of Range, Please try again: ")
 
         while True:
-            if items[itemIndex-1][1] == "access-policy":
-                postfix = "_end_deny"
-            else:
-                postfix = "_end_reject"
-            r = process_item(items[itemIndex-1][0], postfix)
+            r = process_item(items[itemIndex-1][0], get_policy_endings(items[itemIndex-1][1]), transaction)
             if r:
                 break
             else:
@@ -218,5 +788,13 @@ try:
         if contd_s != "y":
             break
 
+    if transaction is not None and transaction.links:
+        print "\nCommitting the staged changes....."
+        if transaction.commit(arguments.commit_timeout) == "COMPLETED":
+            print "Result: SUCCESS"
+        else:
+            print "Result: FAILED, none of the staged changes were applied"
+
 except KeyboardInterrupt:
+    # A staged coordination task is left uncommitted and BIG-IQ drops it
     print "Terminated \n"
@@ -17,48 +17,213 @@
 #################################################################################
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-import json, getpass, sys, os, re
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
+import argparse, contextlib, copy, json, getpass, sys, os, re, threading, time, Queue
 
 URL_POST_POLICY_ITEM = "https://localhost/mgmt/cm/access/working-config/apm/policy/policy-item"
 INDEX_CONFIG = "https://localhost/mgmt/shared/index/config"
 URL_ACCESS_POLICY = "https://localhost/mgmt/cm/access/working-config/apm/policy/access-policy"
 URL_COORDINATOR = "https://localhost/mgmt/shared/coordinator/"
+URL_DEVICE_GROUPS = "https://localhost/mgmt/shared/resolver/device-groups/"
 
 REQ_PAYLOAD_COORDINATOR = {"description":"savePolicyTask","timeoutInSeconds":60}
+COORDINATOR_FINAL_STAGES = ["COMPLETED", "FAILED", "CANCELED"]
 
-def authenticate(auth):
-    response = requests.get(URL_POST_POLICY_ITEM, auth=auth, verify=False)
+# restjavad restarting or too busy, worth another try
+RETRY_STATUSES = [500, 502, 503, 504]
+RETRY_METHODS = ["GET", "PUT", "DELETE"]
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(
+        description='Identify and delete orphan APM objects on BIG-IQ.')
+    parser.add_argument(
+        '--detection',
+        choices=['graph', 'index'],
+        default='graph',
+        help=('how to find orphan policy items: graph fetches the access group '
+              'once and checks references locally, index asks the BIG-IQ '
+              'index about each policy item (default: %(default)s)'))
+    parser.add_argument(
+        '--delete-concurrency',
+        type=int,
+        default=8,
+        help='number of DELETE requests to send at once (default: %(default)s)')
+    parser.add_argument(
+        '--commit-timeout',
+        type=float,
+        default=600,
+        help='seconds to wait for BIG-IQ to commit each coordination task (default: %(default)s)')
+    parser.add_argument(
+        '--page-size',
+        type=int,
+        default=500,
+        help='number of policy items and policies to fetch per request (default: %(default)s)')
+    parser.add_argument(
+        '--access-group', '-g',
+        action='append',
+        help=('access group to clean, can be repeated; "all" cleans every access '
+              'group. Without it the script asks for one group'))
+    parser.add_argument(
+        '--group-concurrency',
+        type=int,
+        default=4,
+        help='number of access groups to clean at once (default: %(default)s)')
+    parser.add_argument(
+        '--credentials-file',
+        help=('file holding "username:password" on its first line. Otherwise '
+              'BIGIQ_USERNAME and BIGIQ_PASSWORD are used if set, or the '
+              'script asks'))
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help=('only find the orphans and print what would be deleted and which '
+              'policies updated, with the REST calls and time per phase; '
+              'nothing is changed'))
+    parser.add_argument(
+        '--results',
+        help='write a JSON result per access group to this file, - for stdout')
+    arguments = parser.parse_args(args)
+    if arguments.delete_concurrency < 1:
+        parser.error('--delete-concurrency must be at least 1')
+    if arguments.page_size < 1:
+        parser.error('--page-size must be at least 1')
+    if arguments.group_concurrency < 1:
+        parser.error('--group-concurrency must be at least 1')
+    return arguments
+
+arguments = parse_arguments(sys.argv[1:])
+
+# Retry policy for BigIqClient. Older urllib3 releases don't take every
+# option, in which case only failed connections are retried.
+def make_retry(total):
+    if Retry is None:
+        return total
+    for methods_option in ("allowed_methods", "method_whitelist"):
+        options = {"total": total,
+                   "backoff_factor": 0.5,
+                   "status_forcelist": RETRY_STATUSES,
+                   "raise_on_status": False,
+                   methods_option: RETRY_METHODS}
+        try:
+            return Retry(**options)
+        except TypeError:
+            pass
+    return total
+
+# Phase of the current thread's work that REST calls are counted against, set
+# by PhaseStats.phase()
+current_phase = threading.local()
+
+def count_request():
+    phase = getattr(current_phase, 'value', None)
+    if phase is not None:
+        phase[0].add(phase[1], calls=1)
+
+# All REST calls go through one keep-alive session with a connection pool big
+# enough for the delete threads, rather than paying a TCP and TLS handshake
+# to localhost for every request.
+class BigIqClient(object):
+    def __init__(self, auth, pool_size, retries=3):
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry(retries))
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        count_request()
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+def make_client(auth):
+    # Deletes are capped globally, plus one connection per group for its
+    # other requests and a couple spare
+    return BigIqClient(auth, arguments.delete_concurrency + arguments.group_concurrency + 2)
+
+# With --results - stdout carries only the JSON, everything else goes to
+# stderr
+results_output = sys.stdout
+if arguments.results == "-":
+    sys.stdout = sys.stderr
+
+# Groups are cleaned from several threads, so whole lines are printed under
+# a lock and tagged with the group they belong to
+output_lock = threading.Lock()
+
+def log_message(message, prefix=""):
+    output_lock.acquire()
+    try:
+        sys.stdout.write(prefix + message + "\n")
+        sys.stdout.flush()
+    finally:
+        output_lock.release()
+
+def authenticate(client):
+    response = client.get(URL_POST_POLICY_ITEM)
     return response.status_code
 
 def get_request_query(url, params):
-    response = requests.get(url, params=params, auth=auth, verify=False)
+    response = client.get(url, params=params)
     response_json = response.json()
     return response_json
 
-###############
-#Authentication
-###############
-os.system("set-basic-auth on")
-print("\nPlease enter the credentials for the BigIQ box (Should have privileges to view, create and modify the access policies):\n")
-auth = HTTPBasicAuth(raw_input("Username: "), getpass.getpass())
-auth_status = authenticate(auth)
-
-while auth_status != 200:
-    if auth_status == 403:
-        print("\nUser doesn't have privileges to access policies. User should have privileges to view, create and modify the access policies. Please enter again the credentials for the BigIQ box:\n")
-    else:
-        print("\nInvalid Credentials. User should have privileges to view, create and modify the access policies. Please enter again the credentials for the BigIQ box:\n")
-    
-    auth = HTTPBasicAuth(raw_input("Username: "), getpass.getpass())
-    auth_status = authenticate(auth)
+# Yield the items of a collection one page at a time, so only a page is held
+# in memory and work on the first items starts before the last page arrives.
+# Follows nextLink when BIG-IQ returns one, otherwise steps $skip by $top
+# until a short page comes back or totalItems have been read. If paging is
+# given, the number of items read and BIG-IQ's totalItems are left in it.
+def iter_collection(url, params, page_size=None, paging=None):
+    if page_size is None:
+        page_size = arguments.page_size
+    if paging is None:
+        paging = {}
+    paging['read'] = 0
+    paging['total'] = None
+    page_params = dict(params)
+    page_params['$top'] = page_size
+    page_params['$skip'] = 0
+    # $skip only pages reliably over a stable order
+    page_params['$orderby'] = 'selfLink'
 
-###############
-#Find and delete orphaned objects
-###############
+    resp = get_request_query(url, page_params)
+    while True:
+        items = resp.get('items', [])
+        if resp.get('totalItems') is not None:
+            paging['total'] = resp['totalItems']
+        for item in items:
+            paging['read'] += 1
+            yield item
+
+        if paging['total'] is not None and paging['read'] >= paging['total']:
+            return
+        if resp.get('nextLink'):
+            resp = get_request(resp['nextLink'])
+        elif len(items) == page_size:
+            page_params['$skip'] += page_size
+            resp = get_request_query(url, page_params)
+        else:
+            return
 
-existing_access_policy_group = raw_input("Please enter the name of the access group to find orphaned objs: ")
-params_find_policy = {"$filter" : "'deviceGroupReference/link' eq 'https://localhost/mgmt/shared/resolver/device-groups/" + existing_access_policy_group + "'"}
+# Template for the kindReferencesResource index query, copied per item
 params = {'referenceMethod':'kindReferencesResource',
             'referenceKind':'cm:access:working-config:apm:policy:policy-item:policyitemstate',
             'referenceLink': '%s',
@@ -66,70 +231,555 @@ params = {'referenceMethod':'kindReferencesResource',
             'inflate':True
             }
 
-params_policy = {'referenceMethod':'kindReferencesResource',
-            'referenceKind':'cm:access:working-config:apm:policy:access-policy:accesspolicystate',
-            'referenceLink': '%s',
-            'referenceDepth':4,
-            'inflate':True
-            }
-
-def put_request(url,req_payload,coordinator_id=None):
-    response = requests.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id}, auth=auth, verify=False)
+def put_request_comp(url,req_payload,coordinator_id=None):
+    response = client.put(url, data=json.dumps(req_payload), headers={"content-type":"application/json", "x-f5-rest-coordination-id":coordinator_id})
     response_json = response.json()
-    return response_json
+    return response, response_json
+
+# Outcome of every DELETE sent during the run, for the report at the end.
+# A DELETE is only staged on the coordination task until the task commits.
+class DeleteReport(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = []
+        self.committed = 0
+
+    def record(self, kind, url, status):
+        self.lock.acquire()
+        try:
+            self.results.append((kind, url, status))
+        finally:
+            self.lock.release()
 
-def delete(url_list, coordinator_id=None):
+    # Called once the coordination task holding the DELETEs so far commits
+    def commit(self):
+        self.lock.acquire()
+        try:
+            self.committed = len(self.results)
+        finally:
+            self.lock.release()
+
+    # Returns the kinds in the order first seen, [deleted, failed, staged]
+    # per kind and the failed deletes
+    def counts(self):
+        kinds = []
+        counts = {}
+        failures = []
+        for index, (kind, url, status) in enumerate(self.results):
+            if kind not in counts:
+                kinds.append(kind)
+                counts[kind] = [0, 0, 0]
+            # 404 means it's already gone, which is what we wanted
+            if status in (200, 202, 204, 404):
+                if index < self.committed:
+                    counts[kind][0] += 1
+                else:
+                    counts[kind][2] += 1
+            else:
+                counts[kind][1] += 1
+                failures.append((kind, url, status))
+        return kinds, counts, failures
+
+    def print_report(self, prefix=""):
+        kinds, counts, failures = self.counts()
+        log_message("Delete report:", prefix)
+        for kind in kinds:
+            line = "  %s: %d deleted, %d failed" % (kind, counts[kind][0], counts[kind][1])
+            if counts[kind][2]:
+                line += ", %d staged but not committed" % counts[kind][2]
+            log_message(line, prefix)
+        for kind, url, status in failures:
+            log_message("  FAILED %s %s: %s" % (kind, url, status), prefix)
+
+# Limits the DELETEs in flight across every group being cleaned
+delete_slots = threading.BoundedSemaphore(arguments.delete_concurrency)
+
+# Send the DELETEs for url_list from a pool of threads, all under the same
+# coordination id, and wait for every one to finish. Callers delete one kind
+# at a time so that nothing is deleted while something else in the same
+# batch still refers to it.
+def delete(url_list, coordinator_id=None, kind='object', report=None):
+    pending = Queue.Queue()
     for url in url_list:
-        response = requests.delete(url, headers={"x-f5-rest-coordination-id":coordinator_id}, auth=auth, verify=False)
+        pending.put(url)
+    phase = getattr(current_phase, 'value', None)
+
+    def worker():
+        current_phase.value = phase
+        while True:
+            try:
+                url = pending.get_nowait()
+            except Queue.Empty:
+                return
+            delete_slots.acquire()
+            try:
+                response = client.delete(url, headers={"x-f5-rest-coordination-id":coordinator_id})
+                status = response.status_code
+            except requests.exceptions.RequestException, e:
+                status = str(e)
+            finally:
+                delete_slots.release()
+            if report is not None:
+                report.record(kind, url, status)
+
+    threads = []
+    for _ in range(min(arguments.delete_concurrency, len(url_list))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+# Resources fetched during this run, by selfLink, so that the same agent,
+# customization group or access policy is only fetched once
+class ResourceCache(object):
+    def __init__(self):
+        self.resources = {}
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def get(self, link):
+        if link in self.resources:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.requests += 1
+            self.resources[link] = get_request(link)
+        return self.resources[link]
+
+    def add(self, resource, replace=True):
+        if replace or resource['selfLink'] not in self.resources:
+            self.resources[resource['selfLink']] = resource
+
+    # Fetch every uncached link with one filtered GET per collection per batch
+    # instead of one GET each. Anything the filter doesn't return is left for
+    # get() to fetch individually.
+    def prefetch(self, links, batch_size=50):
+        by_collection = {}
+        for link in set(links):
+            if link not in self.resources:
+                by_collection.setdefault(link.rsplit('/', 1)[0], []).append(link)
+
+        for collection, collection_links in by_collection.items():
+            for start in range(0, len(collection_links), batch_size):
+                batch = collection_links[start:start + batch_size]
+                query = " or ".join("'selfLink' eq '%s'" % link for link in batch)
+                self.requests += 1
+                resp = get_request_query(collection, {"$filter": query})
+                for resource in resp.get('items', []):
+                    self.add(resource, replace=False)
+
+    def report(self, prefix=""):
+        log_message("Resource cache: %d hits, %d misses, %d requests" % (self.hits, self.misses, self.requests), prefix)
+
+# REST calls made and time spent in each phase of cleaning a group, summed
+# over every pass
+class PhaseStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = []
+        self.calls = {}
+        self.elapsed = {}
+
+    def add(self, name, calls=0, elapsed=0.0):
+        self.lock.acquire()
+        try:
+            if name not in self.calls:
+                self.order.append(name)
+                self.calls[name] = 0
+                self.elapsed[name] = 0.0
+            self.calls[name] += calls
+            self.elapsed[name] += elapsed
+        finally:
+            self.lock.release()
+
+    # REST calls made by this thread inside the with block, and by the delete
+    # threads it starts, are counted against name
+    @contextlib.contextmanager
+    def phase(self, name):
+        previous = getattr(current_phase, 'value', None)
+        current_phase.value = (self, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, elapsed=time.time() - start)
+            current_phase.value = previous
+
+    def as_dict(self):
+        return dict((name, {"calls": self.calls[name], "elapsed": round(self.elapsed[name], 3)})
+                    for name in self.order)
 
-def get_agents_list(policy_item):
+    def report(self, prefix=""):
+        log_message("REST calls and time per phase:", prefix)
+        for name in self.order:
+            log_message("  %-10s %6d calls %8.1fs" % (name, self.calls[name], self.elapsed[name]), prefix)
+
+# Everything that belongs to cleaning one access group: its filter, its
+# resource cache and delete report, the orphans found in the current pass and
+# totals over every pass for the results
+class GroupCleanup(object):
+    def __init__(self, name, prefix_output=False):
+        self.name = name
+        self.prefix = "[%s] " % name if prefix_output else ""
+        self.params_find_policy = {"$filter" : "'deviceGroupReference/link' eq '" + URL_DEVICE_GROUPS + name + "'"}
+        self.resource_cache = ResourceCache()
+        self.delete_report = DeleteReport()
+        self.phases = PhaseStats()
+        self.found = {}
+        self.passes = 0
+        self.plan = None
+        self.update_failures = []
+        self.start_pass()
+
+    def start_pass(self):
+        self.captions = {}
+        self.orphan_agents = {}
+        self.agent_list = set()
+        self.orphan_policy_item_list = []
+        self.customization_group_list = set()
+        # The orphans caught in reference cycles and whatever only they refer
+        # to, which are deleted under a coordination task of their own
+        self.cycle_waves = []
+        self.cycle_agent_list = set()
+        self.cycle_customization_group_list = set()
+
+    def end_pass(self):
+        self.passes += 1
+        for kind, found in (('policy item', self.orphan_policy_item_list),
+                            ('agent', self.agent_list),
+                            ('customization group', self.customization_group_list)):
+            self.found[kind] = self.found.get(kind, 0) + len(found)
+
+    def log(self, message):
+        log_message(message, self.prefix)
+
+    # Leave the given orphans, and the agents and customization groups they
+    # use, out of the deletes
+    def keep(self, links):
+        agents = set()
+        for link in links:
+            agents.update(self.orphan_agents.get(link, ()))
+        groups = set()
+        for agent_link in agents:
+            resp = self.resource_cache.get(agent_link)
+            if 'customizationGroupReference' in resp:
+                groups.add(resp['customizationGroupReference']['link'])
+
+        self.cycle_waves = [[link for link in wave if link not in links] for wave in self.cycle_waves]
+        self.agent_list -= agents
+        self.cycle_agent_list -= agents
+        self.customization_group_list -= groups
+        self.cycle_customization_group_list -= groups
+
+    def result(self, status, elapsed, error=None):
+        kinds, counts, failures = self.delete_report.counts()
+        result = {"group": self.name,
+                  "status": status,
+                  "error": error,
+                  "passes": self.passes,
+                  "found": self.found,
+                  "deleted": dict((kind, counts[kind][0]) for kind in kinds),
+                  "failed": dict((kind, counts[kind][1]) for kind in kinds),
+                  "staged": dict((kind, counts[kind][2]) for kind in kinds),
+                  "update_failed": self.update_failures,
+                  "phases": self.phases.as_dict(),
+                  "elapsed": round(elapsed, 3)}
+        if self.plan is not None:
+            result["plan"] = self.plan
+        return result
+
+    # What this pass would delete and update, in the order it would happen
+    def make_plan(self, orphan_waves, removed_by_policy):
+        policies = []
+        for policy_link, removed in sorted(removed_by_policy.items()):
+            policies.append({"name": self.resource_cache.get(policy_link)['name'],
+                             "selfLink": policy_link,
+                             "remove": sorted(removed)})
+        self.plan = {"policy item": [link for wave in orphan_waves + self.cycle_waves for link in wave],
+                     "cycle policy item": [link for wave in self.cycle_waves for link in wave],
+                     "agent": sorted(self.agent_list),
+                     "customization group": sorted(self.customization_group_list),
+                     "policies": policies}
+
+    def print_plan(self):
+        self.log("Plan:")
+        for kind in ('policy item', 'agent', 'customization group'):
+            self.log("  %s: %d to delete" % (kind, len(self.plan[kind])))
+            for link in self.plan[kind]:
+                if link in self.captions:
+                    self.log("    %s (%s)" % (link, self.captions[link]))
+                else:
+                    self.log("    %s" % link)
+        if self.plan['cycle policy item']:
+            self.log("  %d of the policy items are in or behind reference cycles and are deleted under their own coordination task"
+                     % len(self.plan['cycle policy item']))
+        self.log("  access policies: %d to update" % len(self.plan['policies']))
+        for policy in self.plan['policies']:
+            self.log("    %s: remove %d item(s) from itemList" % (policy['name'], len(policy['remove'])))
+
+def get_agent_links(policy_item):
+    return [agent['nameReference']['link'] for agent in policy_item.get('agents', [])]
+
+def get_agents_list(cleanup, policy_item):
+    cleanup.orphan_agents[policy_item['selfLink']] = get_agent_links(policy_item)
     if 'agents' in policy_item:
         for agent in policy_item['agents']:
-            agent_list.add(agent['nameReference']['link'])
+            cleanup.agent_list.add(agent['nameReference']['link'])
 
-            resp = get_request(agent['nameReference']['link'])
+            resp = cleanup.resource_cache.get(agent['nameReference']['link'])
             if 'customizationGroupReference' in resp:
-                customization_group_list.add(resp['customizationGroupReference']['link'])
+                cleanup.customization_group_list.add(resp['customizationGroupReference']['link'])
 
-def find_orphans_items(policy_item):
+def mark_orphan(cleanup, policy_item):
+    get_agents_list(cleanup, policy_item)
+    if arguments.plan:
+        cleanup.log("**** Found Orphan Policy Item Caption:%s ****" % policy_item['caption'])
+    else:
+        cleanup.log("**** Deleting Orphan Policy Item Caption:%s ****" % policy_item['caption'])
+    cleanup.captions[policy_item['selfLink']] = policy_item['caption']
+    cleanup.orphan_policy_item_list.append(policy_item['selfLink'])
+
+def find_orphans_items(cleanup, policy_item):
     if policy_item['itemType'] != 'entry' and policy_item['itemType'] != 'ending':
-        params['referenceLink'] = policy_item['selfLink']
-        resp = get_request_query(INDEX_CONFIG, params)
+        query = dict(params)
+        query['referenceLink'] = policy_item['selfLink']
+        resp = get_request_query(INDEX_CONFIG, query)
 
         # Policy item is orphan
         if resp['totalItems'] == 0:
-            get_agents_list(policy_item)
-            print("**** Deleting Orphan Policy Item Caption:%s ****" % policy_item['caption'])
-            orphan_policy_item_list.add(policy_item['selfLink'])
-
-
-# Poicly selfLink -> policy object (itemList)
-# if key is present: then change itemList.
-# not present then insert and change itemList
-def update_policy(orphan_policy_item_list, coordinator_id):
-    print("Entering Update Policy")
-    dict_policy = {}
-    for policy_item_link in orphan_policy_item_list:
-        params_policy['referenceLink'] = policy_item_link
-        access_policies = get_request_query(INDEX_CONFIG, params_policy)['items']
-
-        if len(access_policies) > 0:
-            access_policy = access_policies[0]
-            if access_policy['selfLink'] not in dict_policy:
-                dict_policy[access_policy['selfLink']] = access_policy
-            item_list = dict_policy[access_policy['selfLink']]['itemList']
-            item_list_length = len(item_list)
-            index = 0
-            while index < item_list_length:
-                item = item_list[index]
-                if item['nameReference']['link'] == policy_item_link:
-                    del dict_policy[access_policy['selfLink']]['itemList'][index]
-                    break
-                index = index + 1
-
-    for policy_link in dict_policy.keys():
-        put_request(policy_link, dict_policy[policy_link], coordinator_id)
-        print("**** Updating Policy: %s ****" % dict_policy[policy_link]['name'])
+            mark_orphan(cleanup, policy_item)
+
+def find_links(obj):
+    # Every reference link anywhere inside a REST object
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key == 'link' and isinstance(value, basestring):
+                yield value
+            else:
+                for link in find_links(value):
+                    yield link
+    elif isinstance(obj, list):
+        for value in obj:
+            for link in find_links(value):
+                yield link
+
+# Policy item selfLink -> selfLink of the access policy whose itemList holds it
+def build_parent_map(access_policies):
+    parents = {}
+    for policy in access_policies:
+        for entry in policy.get('itemList', []):
+            parents[entry['nameReference']['link']] = policy['selfLink']
+    return parents
+
+# In-memory view of the references between an access group's policy items.
+# referrers maps each policy item selfLink to the policy items that refer to
+# it, which answers the same question as a kindReferencesResource index query
+# without a round trip per item, and references is the reverse.
+class PolicyGraph(object):
+    def __init__(self, policy_items):
+        # References can point at any item, so the graph needs all of them
+        policy_items = list(policy_items)
+        self.item_order = [item['selfLink'] for item in policy_items]
+        self.items = dict((item['selfLink'], item) for item in policy_items)
+
+        self.referrers = {}
+        self.references = {}
+        for item in policy_items:
+            for link in find_links(item):
+                if link in self.items:
+                    self.referrers.setdefault(link, set()).add(item['selfLink'])
+                    self.references.setdefault(item['selfLink'], set()).add(link)
+
+    def is_orphan(self, policy_item, referrers=None):
+        if referrers is None:
+            referrers = self.referrers
+        if policy_item['itemType'] == 'entry' or policy_item['itemType'] == 'ending':
+            return False
+        return len(referrers.get(policy_item['selfLink'], ())) == 0
+
+    # Deleting an orphan drops its references, which may leave the items it
+    # pointed to orphaned in turn. Peel orphans off until none are left, which
+    # finds everything that repeated delete-and-rescan passes would, in one go.
+    # Orphans come back in waves: the first wave has no referrers at all, and
+    # each later wave is only referred to by items in earlier waves, so the
+    # waves can be deleted one after another. Peeling never frees items that
+    # refer to each other in a cycle, so whatever else the entry and ending
+    # items can't reach is returned as a second list of waves, see
+    # order_unreachable.
+    def find_cascading_orphans(self):
+        referrers = dict((link, set(refs)) for link, refs in self.referrers.items())
+        wave = [link for link in self.item_order if self.is_orphan(self.items[link])]
+        found = set(wave)
+
+        waves = []
+        while wave:
+            waves.append([self.items[link] for link in wave])
+
+            next_wave = []
+            for link in wave:
+                for target in self.references.get(link, ()):
+                    referrers[target].discard(link)
+                    if target not in found and self.is_orphan(self.items[target], referrers):
+                        found.add(target)
+                        next_wave.append(target)
+            wave = next_wave
+
+        reachable = self.find_reachable()
+        unreachable = [link for link in self.item_order
+                       if link not in found and link not in reachable]
+
+        return waves, self.order_unreachable(unreachable)
+
+    # Every item reachable by following references from an entry or ending
+    # item, which is what a policy can still get to
+    def find_reachable(self):
+        return self.find_referenced([link for link in self.item_order
+                                     if self.items[link]['itemType'] in ('entry', 'ending')])
+
+    # The given links and every item reachable from them along references
+    def find_referenced(self, links):
+        pending = list(links)
+        reachable = set(pending)
+        while pending:
+            link = pending.pop()
+            for target in self.references.get(link, ()):
+                if target not in reachable:
+                    reachable.add(target)
+                    pending.append(target)
+        return reachable
+
+    # Put the unreachable items in waves that can be deleted one after
+    # another. Items no remaining item refers to are peeled off as before;
+    # when only cycles are left, the cycles nothing else refers to make up
+    # the next wave, since their members can't be deleted one at a time.
+    def order_unreachable(self, unreachable):
+        remaining = set(unreachable)
+        waves = []
+        while remaining:
+            wave = [link for link in unreachable if link in remaining
+                    and not (self.referrers.get(link, set()) & remaining)]
+            if not wave:
+                wave = []
+                for component in self.find_components(remaining):
+                    members = set(component)
+                    if all((self.referrers.get(link, set()) & remaining) <= members
+                           for link in component):
+                        wave += component
+            remaining.difference_update(wave)
+            waves.append([self.items[link] for link in wave])
+        return waves
+
+    # Strongly connected components of the references between links, each
+    # a cycle of items or a single item
+    def find_components(self, links):
+        ordered = [link for link in self.item_order if link in links]
+
+        # Finish order of a depth first walk along references
+        finished = []
+        visited = set()
+        for start in ordered:
+            if start in visited:
+                continue
+            visited.add(start)
+            stack = [(start, iter(self.references.get(start, ())))]
+            while stack:
+                link, targets = stack[-1]
+                for target in targets:
+                    if target in links and target not in visited:
+                        visited.add(target)
+                        stack.append((target, iter(self.references.get(target, ()))))
+                        break
+                else:
+                    stack.pop()
+                    finished.append(link)
+
+        # Walking referrers in reverse finish order collects one component
+        # at a time
+        components = []
+        assigned = set()
+        for start in reversed(finished):
+            if start in assigned:
+                continue
+            assigned.add(start)
+            component = [start]
+            pending = [start]
+            while pending:
+                link = pending.pop()
+                for referrer in self.referrers.get(link, ()):
+                    if referrer in links and referrer not in assigned:
+                        assigned.add(referrer)
+                        component.append(referrer)
+                        pending.append(referrer)
+            components.append(component)
+        return components
+
+# Returns the orphan selfLinks in waves, see find_cascading_orphans. Those
+# behind reference cycles are left in cleanup.cycle_waves, with the agents
+# and customization groups only they use.
+def find_orphans_graph(cleanup, graph):
+    waves, cycle_waves = graph.find_cascading_orphans()
+
+    agent_links = []
+    for wave in waves + cycle_waves:
+        for item in wave:
+            agent_links += get_agent_links(item)
+    cleanup.resource_cache.prefetch(agent_links)
+
+    for wave in waves + cycle_waves:
+        for item in wave:
+            mark_orphan(cleanup, item)
+
+    # Agents still used by an item that isn't deleted yet can't go with the
+    # first coordination task
+    for wave in cycle_waves:
+        for item in wave:
+            for agent_link in get_agent_links(item):
+                cleanup.cycle_agent_list.add(agent_link)
+                resp = cleanup.resource_cache.get(agent_link)
+                if 'customizationGroupReference' in resp:
+                    cleanup.cycle_customization_group_list.add(resp['customizationGroupReference']['link'])
+    cleanup.cycle_waves = [[item['selfLink'] for item in wave] for wave in cycle_waves]
+
+    return [[item['selfLink'] for item in wave] for wave in waves]
+
+# Access policy selfLink -> the orphans to remove from its itemList
+def get_policy_removals(cleanup, parents):
+    removed_by_policy = {}
+    for policy_item_link in cleanup.orphan_policy_item_list:
+        policy_link = parents.get(policy_item_link)
+        if policy_link is not None:
+            removed_by_policy.setdefault(policy_link, set()).add(policy_item_link)
+    return removed_by_policy
+
+# Remove the orphans from their parent policies' itemList. Orphans are
+# grouped by parent first, so each changed policy has its itemList rebuilt
+# once and is PUT once, however many orphans it held.
+# Returns the orphans whose policy couldn't be updated, which are still in
+# its itemList and so must not be deleted.
+def update_policy(cleanup, coordinator_id, removed_by_policy):
+    cleanup.log("Entering Update Policy")
+    kept = set()
+    for policy_link, removed in removed_by_policy.items():
+        # Edit a copy, the cached policy only changes once the PUT succeeds
+        access_policy = copy.deepcopy(cleanup.resource_cache.get(policy_link))
+        access_policy['itemList'] = [entry for entry in access_policy['itemList']
+                                     if entry['nameReference']['link'] not in removed]
+
+        response, updated = put_request_comp(policy_link, access_policy, coordinator_id)
+        if response.status_code not in (200, 202):
+            cleanup.log("**** Failed to update Policy: %s (HTTP %s), keeping its %d orphans ****"
+                        % (access_policy['name'], response.status_code, len(removed)))
+            cleanup.update_failures.append({"policy": access_policy['name'],
+                                            "selfLink": policy_link,
+                                            "status": response.status_code})
+            kept.update(removed)
+            continue
+        # A staged PUT may answer 202 without the policy
+        cleanup.resource_cache.add(updated if 'selfLink' in updated else access_policy)
+        cleanup.log("**** Updating Policy: %s ****" % access_policy['name'])
+    return kept
 
 def patch_coordinator(coordinator_id):
     response_json = {}
@@ -140,54 +790,340 @@ def patch_coordinator(coordinator_id):
             "isCommit": True,
             "stage": "UPDATING"
             }
-        response = requests.patch(URL_COORDINATOR + coordinator_id, data=json.dumps(payload), headers={"content-type":"application/json"}, auth=auth, verify=False)
+        response = client.patch(URL_COORDINATOR + coordinator_id, data=json.dumps(payload), headers={"content-type":"application/json"})
         response_json = response.json()
     return response_json
 
+# Wait for a coordination task to reach a final stage. Polls start quickly and
+# back off exponentially so a long commit isn't hammered with GETs, and the
+# wait gives up after deadline seconds. Prints how long each stage took.
+class CoordinatorWait(object):
+    def __init__(self, deadline, initial_interval=0.25, max_interval=5.0, multiplier=1.5):
+        self.deadline = deadline
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+
+    def wait(self, coordinator_id, coordinator, prefix=""):
+        start = time.time()
+        stage = coordinator.get("stage")
+        stage_start = start
+        interval = self.initial_interval
+
+        while stage not in COORDINATOR_FINAL_STAGES:
+            if stage is None:
+                log_message("Unexpected coordination task response: %s" % coordinator, prefix)
+                return coordinator
+            if time.time() - start >= self.deadline:
+                log_message("Gave up waiting for coordination task %s after %.1fs, still %s" % (coordinator_id, time.time() - start, stage), prefix)
+                return coordinator
+
+            time.sleep(interval)
+            interval = min(interval * self.multiplier, self.max_interval)
+
+            coordinator = get_request(URL_COORDINATOR + coordinator_id)
+            if coordinator.get("stage") != stage:
+                now = time.time()
+                log_message("Coordination task stage %s -> %s after %.1fs" % (stage, coordinator.get("stage"), now - stage_start), prefix)
+                stage = coordinator.get("stage")
+                stage_start = now
+
+        log_message("Coordination task %s %s, commit took %.1fs" % (coordinator_id, stage, time.time() - start), prefix)
+        return coordinator
+
 def get_request(url):
-    response = requests.get(url, auth=auth, verify=False)
+    response = client.get(url)
     response_json = response.json()
     return response_json
 
 def post_request(url,req_payload):
-    response = requests.post(url, data=json.dumps(req_payload), headers={"content-type":"application/json"}, auth=auth, verify=False)
+    response = client.post(url, data=json.dumps(req_payload), headers={"content-type":"application/json"})
     response_json = response.json()
     return response_json
 
-print("Started Deletion.....")
+# Delete the policy item waves one after another, then the agents, then the
+# customization groups. Returns whether anything was sent.
+def delete_orphans(cleanup, coordinator_id, policy_item_waves, agents, customization_groups):
+    sent = False
+    for wave in policy_item_waves:
+        if len(wave) > 0:
+            sent = True
+            delete(wave, coordinator_id, 'policy item', cleanup.delete_report)
+
+    if len(agents) > 0:
+        sent = True
+        delete(agents, coordinator_id, 'agent', cleanup.delete_report)
+
+    if len(customization_groups) > 0:
+        sent = True
+        delete(customization_groups, coordinator_id, 'customization group', cleanup.delete_report)
+    return sent
+
+# Wait for a coordination task that has been told to commit. Returns whether
+# it completed.
+def commit_deletes(cleanup, coordinator_wait, coordinator_id, update_coordinator):
+    update_coordinator = coordinator_wait.wait(coordinator_id, update_coordinator, cleanup.prefix)
+    if update_coordinator.get("stage") != "COMPLETED":
+        cleanup.log("Coordination task did not complete, stopping")
+        return False
+    cleanup.delete_report.commit()
+    return True
+
+# Clean one access group: repeat passes until one finds nothing to delete
+# (index detection) or make a single pass (graph detection). With --plan
+# stop after detection and record what the first pass would do instead.
+def clean_access_group(cleanup, coordinator_wait):
+    start = time.time()
+    status = "ok"
 
-no_delete = False
-while no_delete is False:
-    print("Creating coordination task.....")
+    no_delete = False
+    while no_delete is False:
+        pass_start = time.time()
+        no_delete = True
+        cleanup.start_pass()
 
-    coordinator = post_request(URL_COORDINATOR, REQ_PAYLOAD_COORDINATOR)
-    coordinator_id = coordinator["id"]
+        coordinator_id = None
+        if not arguments.plan:
+            cleanup.log("Creating coordination task.....")
+            with cleanup.phases.phase("commit"):
+                coordinator = post_request(URL_COORDINATOR, REQ_PAYLOAD_COORDINATOR)
+            coordinator_id = coordinator["id"]
 
-    no_delete = True
+        # One fetch of the group's policies gives every item's parent
+        with cleanup.phases.phase("policies"):
+            access_policies = list(iter_collection(URL_ACCESS_POLICY, cleanup.params_find_policy))
+            for policy in access_policies:
+                cleanup.resource_cache.add(policy)
+
+        # Policy items are paged in as detection consumes them
+        with cleanup.phases.phase("detection"):
+            paging = {}
+            all_policy_items = iter_collection(URL_POST_POLICY_ITEM, cleanup.params_find_policy, paging=paging)
+
+            graph = None
+            if arguments.detection == 'graph':
+                graph = PolicyGraph(all_policy_items)
+                if paging['total'] is not None and paging['read'] != paging['total']:
+                    # An item that wasn't read could be the only referrer of
+                    # one that was, which would then look orphaned. The index
+                    # sees every reference, so check each item there instead.
+                    cleanup.log("Read %d of %d policy items, using index detection" % (paging['read'], paging['total']))
+                    seen = set()
+                    all_policy_items = []
+                    for link in graph.item_order:
+                        if link not in seen:
+                            seen.add(link)
+                            all_policy_items.append(graph.items[link])
+                    graph = None
+            if graph is not None:
+                orphan_waves = find_orphans_graph(cleanup, graph)
+            else:
+                for item in all_policy_items:
+                    find_orphans_items(cleanup, item)
+                orphan_waves = [cleanup.orphan_policy_item_list]
+        cleanup.end_pass()
+
+        removed_by_policy = get_policy_removals(cleanup, build_parent_map(access_policies))
+
+        if arguments.plan:
+            cleanup.make_plan(orphan_waves, removed_by_policy)
+            cleanup.print_plan()
+            if graph is None:
+                # Later passes only happen once these are really deleted
+                cleanup.log("  (index detection: items only orphaned by these deletions are not included)")
+            break
+
+        with cleanup.phases.phase("update"):
+            kept = update_policy(cleanup, coordinator_id, removed_by_policy)
+        if kept:
+            if graph is not None:
+                # Whatever a kept item refers to is still in use too
+                kept = graph.find_referenced(kept)
+            orphan_waves = [[link for link in wave if link not in kept] for wave in orphan_waves]
+            cleanup.keep(kept)
+            status = "update-failed"
+
+        with cleanup.phases.phase("delete"):
+            if delete_orphans(cleanup, coordinator_id, orphan_waves,
+                              cleanup.agent_list - cleanup.cycle_agent_list,
+                              cleanup.customization_group_list - cleanup.cycle_customization_group_list):
+                no_delete = False
+
+        cleanup.log("Client-side work took %.1fs" % (time.time() - pass_start))
+        with cleanup.phases.phase("commit"):
+            update_coordinator = patch_coordinator(coordinator_id)
+            if no_delete is False:
+                if not commit_deletes(cleanup, coordinator_wait, coordinator_id, update_coordinator):
+                    # Another pass would only run into the same problem
+                    status = "commit-failed"
+                    no_delete = True
+
+        # A DELETE BIG-IQ rejects fails the whole commit, so the cycles get a
+        # coordination task of their own once everything else is gone
+        if any(cleanup.cycle_waves) and status in ("ok", "update-failed"):
+            cleanup.log("Creating coordination task for %d policy items behind reference cycles....."
+                        % sum(len(wave) for wave in cleanup.cycle_waves))
+            with cleanup.phases.phase("commit"):
+                coordinator_id = post_request(URL_COORDINATOR, REQ_PAYLOAD_COORDINATOR)["id"]
+            with cleanup.phases.phase("delete"):
+                delete_orphans(cleanup, coordinator_id, cleanup.cycle_waves,
+                               cleanup.cycle_agent_list, cleanup.cycle_customization_group_list)
+            with cleanup.phases.phase("commit"):
+                update_coordinator = patch_coordinator(coordinator_id)
+                if not commit_deletes(cleanup, coordinator_wait, coordinator_id, update_coordinator):
+                    status = "commit-failed"
+
+        if graph is not None:
+            # The cascade was found in full, another pass would find nothing
+            no_delete = True
+        if kept:
+            # Another pass would only run into the same problem
+            no_delete = True
+
+    if not arguments.plan:
+        cleanup.delete_report.print_report(cleanup.prefix)
+    cleanup.phases.report(cleanup.prefix)
+    cleanup.resource_cache.report(cleanup.prefix)
+
+    if status == "ok" and cleanup.delete_report.counts()[2]:
+        status = "delete-failed"
+    return cleanup.result(status, time.time() - start)
+
+# Clean each access group in group_names, at most workers of them at once,
+# and return their results in the same order
+def clean_access_groups(group_names, workers):
+    coordinator_wait = CoordinatorWait(arguments.commit_timeout)
+    prefix_output = len(group_names) > 1
+
+    pending = Queue.Queue()
+    for name in group_names:
+        pending.put(name)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                name = pending.get_nowait()
+            except Queue.Empty:
+                return
+            cleanup = GroupCleanup(name, prefix_output)
+            start = time.time()
+            try:
+                results[name] = clean_access_group(cleanup, coordinator_wait)
+            except Exception, e:
+                cleanup.log("Cleaning access group failed: %s" % e)
+                results[name] = cleanup.result("error", time.time() - start, str(e))
+
+    threads = []
+    for _ in range(min(workers, len(group_names))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return [results[name] for name in group_names]
+
+# Names of the device groups that hold access policies. device-groups also
+# lists BIG-IP and system groups, so only groups an access policy refers to
+# are kept.
+def get_access_group_names():
+    policy_groups = set()
+    for policy in iter_collection(URL_ACCESS_POLICY, {"$select": "deviceGroupReference"}):
+        if 'deviceGroupReference' in policy:
+            policy_groups.add(policy['deviceGroupReference']['link'].rsplit('/', 1)[-1])
+
+    names = []
+    for group in iter_collection(URL_DEVICE_GROUPS, {"$select": "groupName"}):
+        if group['groupName'] in policy_groups:
+            names.append(group['groupName'])
+    return names
+
+def get_group_names(access_groups):
+    if 'all' in access_groups:
+        return get_access_group_names()
+    names = []
+    for name in access_groups:
+        if name not in names:
+            names.append(name)
+    return names
+
+# (username, password) from --credentials-file or the environment, None if
+# neither has them
+def read_credentials():
+    if arguments.credentials_file:
+        with open(arguments.credentials_file) as credentials_file:
+            line = credentials_file.readline().rstrip("\r\n")
+        username, _, password = line.partition(":")
+        return username, password
+    if os.environ.get("BIGIQ_USERNAME") and "BIGIQ_PASSWORD" in os.environ:
+        return os.environ["BIGIQ_USERNAME"], os.environ["BIGIQ_PASSWORD"]
+    return None
+
+def write_results(results, path):
+    document = json.dumps({"groups": results}, indent=2, sort_keys=True, separators=(",", ": "))
+    if path == "-":
+        results_output.write(document + "\n")
+    else:
+        with open(path, "w") as results_file:
+            results_file.write(document + "\n")
+
+###############
+#Authentication
+###############
+if arguments.results == "-":
+    os.system("set-basic-auth on 1>&2")
+else:
+    os.system("set-basic-auth on")
+credentials = read_credentials()
+if credentials is not None:
+    client = make_client(HTTPBasicAuth(*credentials))
+    auth_status = authenticate(client)
+    if auth_status != 200:
+        print("\nAuthentication failed (HTTP %s). User should have privileges to view, create and modify the access policies." % auth_status)
+        sys.exit(1)
+elif arguments.access_group and not sys.stdin.isatty():
+    print("\nNo credentials given. Set BIGIQ_USERNAME and BIGIQ_PASSWORD or use --credentials-file.")
+    sys.exit(1)
+else:
+    print("\nPlease enter the credentials for the BigIQ box (Should have privileges to view, create and modify the access policies):\n")
+    client = make_client(HTTPBasicAuth(raw_input("Username: "), getpass.getpass()))
+    auth_status = authenticate(client)
+
+    while auth_status != 200:
+        if auth_status == 403:
+            print("\nUser doesn't have privileges to access policies. User should have privileges to view, create and modify the access policies. Please enter again the credentials for the BigIQ box:\n")
+        else:
+            print("\nInvalid Credentials. User should have privileges to view, create and modify the access policies. Please enter again the credentials for the BigIQ box:\n")
+
+        client = make_client(HTTPBasicAuth(raw_input("Username: "), getpass.getpass()))
+        auth_status = authenticate(client)
+
+###############
+#Find and delete orphaned objects
+###############
 
-    agent_list = set()
-    orphan_policy_item_list = set()
-    customization_group_list = set()
+if arguments.access_group:
+    group_names = get_group_names(arguments.access_group)
+else:
+    group_names = [raw_input("Please enter the name of the access group to find orphaned objs: ")]
 
-    all_policy_items = get_request_query(URL_POST_POLICY_ITEM, params_find_policy)
-    for item in all_policy_items['items']:
-        find_orphans_items(item)
-      
-    update_policy(orphan_policy_item_list, coordinator_id)
+if arguments.plan:
+    print("Planning, nothing will be changed.....")
+else:
+    print("Started Deletion.....")
 
-    if len(orphan_policy_item_list) > 0:
-        no_delete = False
-        delete(orphan_policy_item_list, coordinator_id)
+results = clean_access_groups(group_names, arguments.group_concurrency)
 
-    if len(agent_list) > 0:
-        no_delete = False
-        delete(agent_list, coordinator_id)
+if len(results) > 1:
+    print("Summary:")
+    for result in results:
+        print("  %s: %s, %d orphans found, %d deleted, %d failed, %.1fs" % (
+            result["group"], result["status"], sum(result["found"].values()),
+            sum(result["deleted"].values()), sum(result["failed"].values()), result["elapsed"]))
 
-    if len(customization_group_list) > 0:
-        no_delete = False
-        delete(customization_group_list, coordinator_id)
+if arguments.results:
+    write_results(results, arguments.results)
 
-    update_coordinator = patch_coordinator(coordinator_id)
-    if no_delete is False:
-        while update_coordinator["stage"] != "COMPLETED":
-            update_coordinator = get_request(URL_COORDINATOR + coordinator_id)
+if [result for result in results if result["status"] != "ok"]:
+    sys.exit(1)
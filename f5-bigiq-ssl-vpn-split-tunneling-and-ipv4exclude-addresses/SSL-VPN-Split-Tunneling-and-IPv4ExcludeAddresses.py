@@ -17,12 +17,25 @@
 #################################################################################
  
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
 import json, getpass, sys, os, re
 from pprint import pprint
 
 NETWORK_ACCESS_URI = "https://localhost/mgmt/cm/access/working-config/apm/resource/network-access"
 ACCESS_GROUP_URI = "https://localhost/mgmt/shared/resolver/device-groups/"
+# Network Access objects fetched per request
+PAGE_SIZE = 500
+
+# Only GETs are retried when restjavad answers with a transient server
+# error. The script's one other method, PATCH, appends to the exclude list,
+# so a retry after BIG-IQ applied it would add the subnets twice.
+RETRY_STATUSES = [500, 502, 503, 504]
+RETRY_METHODS = ["GET"]
 
 def get_username():
     return raw_input("Username: ")
@@ -39,6 +52,39 @@ def get_ipv4_exlude_address_list():
 def should_update_all():
     return raw_input("Do you want to update all of them? (y/n) : ") == "y"
 
+# Newer urllib3 calls method_whitelist allowed_methods. Without a usable Retry
+# just retry the connection.
+def make_retry(total):
+    if Retry is None:
+        return total
+    for methods_option in ("allowed_methods", "method_whitelist"):
+        options = {"total": total,
+                   "backoff_factor": 0.5,
+                   "status_forcelist": RETRY_STATUSES,
+                   "raise_on_status": False,
+                   methods_option: RETRY_METHODS}
+        try:
+            return Retry(**options)
+        except TypeError:
+            pass
+    return total
+
+# Keep-alive session shared by all REST calls, so updating many Network
+# Access objects doesn't open a new connection per PATCH
+class BigIqClient(object):
+    def __init__(self, auth, pool_size=4, retries=3):
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry(retries))
+        self.session.mount("https://", adapter)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.session.patch(url, **kwargs)
+
 ###############
 #Authentication
 ###############
@@ -47,8 +93,8 @@ print("This script changes the configurations on BIG-IQ. You need to evaluate an
 print("\nNOTE: This script will set-basic-auth on. Please turn it off using the command, set-basic-auth off, after running the script if you don't want to keep it ON.")
 os.system("set-basic-auth on")
 print("\nPlease enter the credentials for User on the BIG-IQ box (User must have privileges to view and modify the Network Access configurations):\n")
-auth = HTTPBasicAuth(get_username(), get_password())
-networkAccessGETResponse = requests.get(NETWORK_ACCESS_URI + "?$select=name", auth=auth, verify=False)
+client = BigIqClient(HTTPBasicAuth(get_username(), get_password()))
+networkAccessGETResponse = client.get(NETWORK_ACCESS_URI + "?$select=name")
 
 while networkAccessGETResponse.status_code != 200:
     if networkAccessGETResponse.status_code == 403:
@@ -56,8 +102,8 @@ while networkAccessGETResponse.status_code != 200:
     else:
         print("\nInvalid credentials. Please try again:\n")
 
-    auth = HTTPBasicAuth(get_username(), get_password())
-    networkAccessGETResponse = requests.get(NETWORK_ACCESS_URI + "?$select=name", auth=auth, verify=False)
+    client = BigIqClient(HTTPBasicAuth(get_username(), get_password()))
+    networkAccessGETResponse = client.get(NETWORK_ACCESS_URI + "?$select=name")
 
 ###############
 # User Inputs:
@@ -67,7 +113,7 @@ while networkAccessGETResponse.status_code != 200:
 print("\nEnter the Access Group name of the BIG-IP devices for which you want to update the Network Access configurations.")
 access_group_name = get_access_group_name()
 
-access_group_status = requests.get(ACCESS_GROUP_URI + access_group_name, auth=auth, verify=False).status_code
+access_group_status = client.get(ACCESS_GROUP_URI + access_group_name).status_code
 if access_group_status == 404:
     print("\n Access Group (" + access_group_name + ") does not exist. Please check and try again.")
     sys.exit()
@@ -77,10 +123,39 @@ if access_group_status == 404:
 ################
 
 def get_request_query(url, params):
-    response = requests.get(url, params=params, auth=auth, verify=False)
+    response = client.get(url, params=params)
     response_json = response.json()
     return response_json
 
+def get_page(url, params, skip=0):
+    page_params = dict(params)
+    page_params["$top"] = PAGE_SIZE
+    page_params["$skip"] = skip
+    # $skip only pages reliably over a stable order
+    page_params["$orderby"] = "selfLink"
+    return get_request_query(url, page_params)
+
+def iter_collection(url, params, first_page):
+    """
+    Yield the items of a collection a page at a time, starting from
+    first_page as returned by get_page. Follows nextLink when present,
+    otherwise fetches the next $skip until a short page comes back.
+    """
+    page = first_page
+    skip = 0
+    while True:
+        items = page.get("items", [])
+        for item in items:
+            yield item
+
+        if page.get("nextLink"):
+            page = client.get(page["nextLink"]).json()
+        elif len(items) == PAGE_SIZE:
+            skip += PAGE_SIZE
+            page = get_page(url, params, skip)
+        else:
+            return
+
 def convertAddressFormat(addr):
     """
     If addr is of the form 192.168.1.64/255.255.255.0, convert it
@@ -112,23 +187,27 @@ def checkPatchResponse(patchResponse):
         sys.exit()
 
 paramsForGroupFilter  = { "$filter": " 'lsoDeviceReference/link' eq '*' and 'isLsoShared' eq 'false' and 'deviceGroupReference/link' eq 'https://localhost/mgmt/shared/resolver/device-groups/"+ access_group_name +"'", "$select": "selfLink,addressSpaceExcludeSubnet"}
-allNetworkAccessObjects = get_request_query(NETWORK_ACCESS_URI, paramsForGroupFilter)
+# Only the first page is needed to report the count, the rest are fetched
+# while updating
+firstNetworkAccessPage = get_page(NETWORK_ACCESS_URI, paramsForGroupFilter)
 
-if allNetworkAccessObjects["totalItems"] == 0:
+if firstNetworkAccessPage["totalItems"] == 0:
     print("\nThere aren't any device-specific Network Access configurations under the given Access Group.")
     sys.exit()
 else:
-    print("\nFound "+ str(allNetworkAccessObjects["totalItems"]) +" configurations under the Access Group "+ access_group_name +".\n")
+    print("\nFound "+ str(firstNetworkAccessPage["totalItems"]) +" configurations under the Access Group "+ access_group_name +".\n")
 
 if should_update_all():
     ipv4ExcludeAddressList = getUserInputForAddressList() 
-    for networkAccessObject in allNetworkAccessObjects["items"]:
+    # Pages are ordered by selfLink and the PATCH doesn't touch anything the
+    # filter looks at, so objects stay on their page while being updated
+    for networkAccessObject in iter_collection(NETWORK_ACCESS_URI, paramsForGroupFilter, firstNetworkAccessPage):
         for newIpAddress in ipv4ExcludeAddressList:
             if "addressSpaceExcludeSubnet" not in networkAccessObject:
                 networkAccessObject["addressSpaceExcludeSubnet"] = []
             networkAccessObject["addressSpaceExcludeSubnet"].append({"subnet": newIpAddress, "generation": 0, "lastUpdateMicros": 0})
         url = networkAccessObject["selfLink"]
-        patchResponse = requests.patch(url, data=json.dumps(networkAccessObject), headers={"content-type":"application/json"}, auth=auth, verify=False)
+        patchResponse = client.patch(url, data=json.dumps(networkAccessObject), headers={"content-type":"application/json"})
         checkPatchResponse(patchResponse)
 else:
     sys.exit()
\ No newline at end of file